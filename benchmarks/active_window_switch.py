@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+#   active_window_switch.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures what a focus change costs DockBar with different numbers of
+# groups. The active window handler of a real DockBar is run with fake
+# screen, windows and groups, so only the dock's own bookkeeping is
+# measured. The time per focus change should be the same for every
+# group count. The number of groups that are told about each change is
+# printed too and should be at most two.
+#
+# Needs the same python modules as dockbarx, but no X display.
+#
+# Usage: python3 benchmarks/active_window_switch.py [switches]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dockbarx.dockbar import DockBar
+
+
+class FakeScreen():
+    def __init__(self):
+        self.active_window = None
+
+    def get_active_window(self):
+        return self.active_window
+
+class FakeGroup():
+    def __init__(self):
+        self.has_active_window = False
+        self.calls = 0
+
+    def set_active_window(self, window=None):
+        self.calls += 1
+        self.has_active_window = window is not None
+
+
+def run(group_count, switches):
+    # A DockBar without __init__, with just what the handler uses.
+    dockbar = DockBar.__new__(DockBar)
+    dockbar.active_group_r = None
+    dockbar.windows = {}
+    dockbar.groups = {}
+    windows = []
+    for i in range(group_count):
+        identifier = "app%s" % i
+        window = "window%s" % i
+        dockbar.groups[identifier] = FakeGroup()
+        dockbar.windows[window] = identifier
+        windows.append(window)
+    screen = FakeScreen()
+    handler = dockbar._DockBar__on_active_window_changed
+    # Switch between windows spread over the whole dock.
+    step = max(group_count // 7, 1)
+    start = time.time()
+    for i in range(switches):
+        screen.active_window = windows[(i * step) % group_count]
+        handler(screen, None)
+    us = (time.time() - start) * 1000000 / switches
+    calls = sum([group.calls for group in dockbar.groups.values()])
+    return us, float(calls) / switches
+
+def main():
+    switches = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("groups\tus/switch\tgroups notified/switch")
+    for group_count in (10, 100, 1000, 10000):
+        us, calls = run(group_count, switches)
+        print("%s\t%.2f\t\t%.2f" % (group_count, us, calls))
+
+if __name__ == "__main__":
+    main()
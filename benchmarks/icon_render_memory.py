@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+#   icon_render_memory.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Renders every icon state of the current theme over and over again
+# and prints the render time and the resident memory of the process.
+# The shared surface cache is emptied between the rounds so that
+# every round really renders. Memory should stay flat after the first
+# rounds even though the garbage collector never runs.
+#
+# Needs an X display, dockbarx's gsettings schema and an installed theme.
+#
+# Usage: python3 benchmarks/icon_render_memory.py [rounds] [size]
+
+import os
+import sys
+import gc
+import time
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk
+
+from dockbarx.iconfactory import IconFactory
+from dockbarx.surfacecache import SurfaceCache, DiskSurfaceCache, SurfacePool
+
+
+class FakeDockbar():
+    orient = "down"
+
+class FakeGroup():
+    def __init__(self, dockbar):
+        self.dockbar_r = weakref.ref(dockbar)
+
+
+def get_rss():
+    # Resident memory in KiB.
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 48
+    # The garbage collector never runs, surfaces must be freed by
+    # reference counting alone. Memory that grows from round to
+    # round is held by reference cycles.
+    gc.disable()
+    dockbar = FakeDockbar()
+    group = FakeGroup(dockbar)
+    icon_factory = IconFactory(group, identifier="firefox")
+    icon_factory.set_size(size)
+    DiskSurfaceCache().enabled = False
+    cache = SurfaceCache()
+    types = [0] + list(IconFactory.TYPE_DICT.values())
+    states = [t | n for t in types for n in (0, 1, 2, 3)]
+    print("Rendering %s states at size %s, %s rounds" % (len(states),
+                                                         size, rounds))
+    print("round\tms/round\tRSS KiB\tpooled")
+    start_rss = None
+    for i in range(rounds):
+        cache.clear()
+        t = time.time()
+        for state in states:
+            icon_factory.surface_update(state)
+        ms = (time.time() - t) * 1000
+        rss = get_rss()
+        if i == 2:
+            # The first rounds fill the pool and the icon theme caches.
+            start_rss = rss
+        if i % max(rounds // 20, 1) == 0 or i == rounds - 1:
+            print("%s\t%.1f\t%s\t%s" % (i, ms, rss, SurfacePool().count))
+    if start_rss is not None:
+        print("RSS growth after warm up: %s KiB" % (get_rss() - start_rss))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+#   preview_capture.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares the latency of capturing a window preview with get_image
+# over the X connection and with MIT-SHM. Pixmaps of 1080p and 4K size
+# are captured (windows that big may not fit on the screen) and scaled
+# to a preview like the preview thread does.
+#
+# Needs an X display (Xvfb works) and the same python modules as
+# dockbarx. MIT-SHM needs libxcb-shm and an X server on this machine.
+#
+# Usage: python3 benchmarks/preview_capture.py [captures]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from Xlib import display
+
+from dockbarx.previews import get_image, scale_bgra
+from dockbarx.xshm import ShmImageReader
+
+SIZES = (("1080p", 1920, 1080), ("4K", 3840, 2160))
+PREVIEW_WIDTH = 300
+
+
+def make_pixmap(d, width, height):
+    screen = d.screen()
+    pixmap = screen.root.create_pixmap(width, height, screen.root_depth)
+    gc = pixmap.create_gc(foreground=screen.white_pixel)
+    pixmap.fill_rectangle(gc, 0, 0, width, height)
+    gc.free()
+    d.sync()
+    return pixmap
+
+def measure(capture, xid, width, height, captures):
+    # Returns the median milliseconds of capture and of capture + scale.
+    preview_height = PREVIEW_WIDTH * height // width
+    capture_times = []
+    total_times = []
+    for i in range(captures):
+        start = time.time()
+        image = capture(xid)
+        captured = time.time()
+        scale_bgra(image[0], image[1], image[2],
+                   PREVIEW_WIDTH, preview_height)
+        end = time.time()
+        capture_times.append((captured - start) * 1000)
+        total_times.append((end - start) * 1000)
+    capture_times.sort()
+    total_times.sort()
+    return capture_times[captures // 2], total_times[captures // 2]
+
+def main():
+    captures = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    d = display.Display()
+    shm = ShmImageReader()
+    backends = [("get_image", lambda xid: get_image(d, xid))]
+    if shm.available:
+        backends.append(("MIT-SHM", shm.get_image))
+    else:
+        print("MIT-SHM is not available, only get_image is measured.")
+    print("size\tbackend\t\tcapture ms\tcapture + scale ms")
+    for name, width, height in SIZES:
+        pixmap = make_pixmap(d, width, height)
+        for backend, capture in backends:
+            if capture(pixmap.id) is None:
+                print("%s\t%s\tfailed" % (name, backend))
+                continue
+            capture_ms, total_ms = measure(capture, pixmap.id,
+                                           width, height, captures)
+            print("%s\t%-9s\t%.1f\t\t%.1f" % (name, backend,
+                                             capture_ms, total_ms))
+        pixmap.free()
+    shm.close()
+    d.close()
+
+if __name__ == "__main__":
+    main()
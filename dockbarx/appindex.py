@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+
+#   appindex.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+from collections import deque
+
+from gi.repository import GObject
+from gi.repository import Gio
+from gi.repository import GLib
+
+from .appmatcher import AppMatcher
+from .common import DesktopEntry
+from .log import logger
+
+# Executables that only start the real program.
+WRAPPERS = ("sudo", "gksudo", "java", "mono", "ruby", "python")
+# Number of apps added to the index per idle callback.
+CHUNK_SIZE = 50
+# Installing a package can change many desktop files,
+# wait for it to settle before updating the index.
+UPDATE_DELAY = 1000
+MEMO_VERSION = 1
+# Seconds to wait before the memo is saved after a change.
+MEMO_SAVE_DELAY = 5
+
+
+class AppIndex(GObject.GObject):
+    """An index of the installed applications (Gio.AppInfo).
+
+    The index is built a few apps at a time when the main loop is idle,
+    so that it doesn't delay the start of the dock. When Gio reports
+    that the installed applications have changed, only the apps that
+    were added, removed or changed are updated. "changed" is emitted
+    when the index has been built and every time it's updated."""
+
+    __gsignals__ = {
+        "changed": (GObject.SignalFlags.RUN_FIRST, GObject.TYPE_NONE, ()),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.apps_by_id = {}
+        self.matcher = AppMatcher()
+        self.wine_app_ids_by_program = {}
+        # id: the values the app was indexed with.
+        self.entries = {}
+        self.loaded = False
+        self.pending = None
+        self.load_sid = None
+        self.update_sid = None
+        try:
+            self.monitor = Gio.AppInfoMonitor.get()
+        except AttributeError:
+            # Gio.AppInfoMonitor needs GLib 2.40 or newer.
+            logger.debug("Gio.AppInfoMonitor is not available, " + \
+                         "installed applications will not be monitored.")
+            self.monitor = None
+        else:
+            self.monitor.connect("changed", self.__on_apps_changed)
+
+    def load(self):
+        """Starts building the index when the main loop is idle."""
+        if self.loaded or self.load_sid is not None:
+            return
+        self.load_sid = GLib.idle_add(self.__load_step,
+                                      priority=GLib.PRIORITY_LOW)
+
+    def load_now(self):
+        """Finishes building the index right away."""
+        if self.load_sid is not None:
+            GLib.source_remove(self.load_sid)
+            self.load_sid = None
+        while not self.loaded:
+            self.__load_step()
+
+    def find_app(self, identifier):
+        app_id = self.matcher.find(identifier)
+        if app_id:
+            return self.apps_by_id[app_id]
+        return None
+
+    def find_chromium_app(self, identifier):
+        app_id = self.matcher.find_chromium(identifier)
+        if app_id:
+            return self.apps_by_id[app_id]
+        return None
+
+    def find_wine_app(self, program):
+        app_id = self.wine_app_ids_by_program.get(program)
+        if app_id:
+            return self.apps_by_id[app_id]
+        return None
+
+    def __load_step(self):
+        if self.pending is None:
+            # The enumeration itself gets an idle callback of its own.
+            self.pending = deque(self.__get_apps())
+            return True
+        for i in range(CHUNK_SIZE):
+            if not self.pending:
+                break
+            self.__add(*self.pending.popleft())
+        if self.pending:
+            return True
+        self.pending = None
+        self.load_sid = None
+        self.loaded = True
+        self.emit("changed")
+        return False
+
+    def __get_apps(self):
+        # Returns a list of (id, app, entry) for every app.
+        apps = []
+        for app in Gio.app_info_get_all():
+            exe = app.get_executable()
+            if not exe:
+                continue
+            id = app.get_id()
+            id = id[:id.rfind(".")].lower()
+            name = app.get_name().lower()
+            try:
+                cmd = (app.get_commandline() or "").lower()
+            except AttributeError:
+                # Older versions of gio doesn't have get_comandline.
+                cmd = ""
+            try:
+                wm_class = app.get_startup_wm_class()
+            except AttributeError:
+                # Not a Gio.DesktopAppInfo.
+                wm_class = None
+            apps.append((id, app, (name, exe, cmd, wm_class)))
+        return apps
+
+    def __add(self, id, app, entry):
+        if id in self.entries:
+            self.__remove(id)
+        name, exe, cmd, wm_class = entry
+        self.apps_by_id[id] = app
+        self.entries[id] = entry
+        if id[:5] == "wine-" and cmd.find(".exe") > 0:
+            program = cmd[:cmd.rfind(".exe")+4]
+            program = program[program.rfind("\\")+1:]
+            self.wine_app_ids_by_program[program] = id
+        if exe in WRAPPERS:
+            exe = None
+        self.matcher.add(id, name=name, exe=exe, cmd=cmd, wm_class=wm_class)
+
+    def __remove(self, id):
+        self.apps_by_id.pop(id, None)
+        self.entries.pop(id, None)
+        self.matcher.remove(id)
+        for program, app_id in list(self.wine_app_ids_by_program.items()):
+            if app_id == id:
+                del self.wine_app_ids_by_program[program]
+
+    def __on_apps_changed(self, *args):
+        if self.update_sid is not None:
+            GLib.source_remove(self.update_sid)
+        self.update_sid = GLib.timeout_add(UPDATE_DELAY, self.__update)
+
+    def __update(self):
+        if not self.loaded:
+            # Try again when the index has been built.
+            return True
+        self.update_sid = None
+        apps = {}
+        for id, app, entry in self.__get_apps():
+            apps[id] = (app, entry)
+        changed = False
+        for id in list(self.entries.keys()):
+            if not id in apps:
+                self.__remove(id)
+                changed = True
+        for id, (app, entry) in list(apps.items()):
+            if self.entries.get(id) != entry:
+                self.__add(id, app, entry)
+                changed = True
+            else:
+                self.apps_by_id[id] = app
+        if changed:
+            logger.debug("Installed applications changed.")
+            self.emit("changed")
+        return False
+
+
+def get_applications_folders():
+    # The applications folders in the order they are searched.
+    user_folder = os.environ.get("XDG_DATA_HOME",
+                                 os.path.join(os.path.expanduser("~"),
+                                              ".local", "share"))
+    data_folders = os.environ.get("XDG_DATA_DIRS",
+                                  "/usr/local/share/:/usr/share/")
+    folders = [user_folder] + data_folders.split(":")
+    return [os.path.join(folder, "applications") for folder in folders
+            if folder]
+
+
+class DesktopFileIndex():
+    """A map from desktop file ids to the paths of the desktop files.
+
+    The id of a desktop file in a subfolder is "[subfolder]-[basename]"
+    and the first applications folder that has the id wins. The folders
+    are monitored and the index is rebuilt on the first lookup after
+    something has changed in them."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "paths" in self.__dict__:
+            return
+        self.paths = {}
+        self.monitors = {}
+        self.dirty = True
+
+    def get_path(self, id):
+        if self.dirty:
+            self.__rebuild()
+        return self.paths.get(id)
+
+    def __rebuild(self):
+        self.dirty = False
+        paths = {}
+        folders = []
+        for apps_folder in get_applications_folders():
+            folders.append(apps_folder)
+            for dirpath, dirnames, filenames in os.walk(apps_folder):
+                if dirpath != apps_folder:
+                    folders.append(dirpath)
+                prefix = os.path.relpath(dirpath, apps_folder)
+                if prefix == ".":
+                    prefix = ""
+                else:
+                    prefix = prefix.replace(os.sep, "-") + "-"
+                for filename in filenames:
+                    if not filename.endswith(".desktop"):
+                        continue
+                    paths.setdefault(prefix + filename,
+                                     os.path.join(dirpath, filename))
+        self.paths = paths
+        self.__update_monitors(folders)
+
+    def __update_monitors(self, folders):
+        for folder in list(self.monitors.keys()):
+            if not folder in folders:
+                self.monitors.pop(folder).cancel()
+        for folder in folders:
+            if folder in self.monitors:
+                continue
+            # Folders that don't exist yet are monitored too,
+            # Gio tells when they are created.
+            try:
+                monitor = Gio.File.new_for_path(folder).monitor_directory(
+                                            Gio.FileMonitorFlags.NONE, None)
+            except GLib.GError:
+                logger.warning("Couldn't monitor %s" % folder)
+                continue
+            monitor.connect("changed", self.__on_folder_changed)
+            self.monitors[folder] = monitor
+
+    def __on_folder_changed(self, *args):
+        self.dirty = True
+
+
+class AppMemo():
+    """Remembers which desktop file the windows of an identifier got.
+
+    The memo is saved in the user cache directory, so that windows of
+    known applications get their desktop entry right away, without
+    matching and even before the AppIndex has been built. An entry is
+    only used if the desktop file is still the one its id points to
+    and hasn't been modified since.
+
+    Only the app lookup is saved. The memo is keyed on the final group
+    identifier, so the identifier of a window is still worked out from
+    its class, and the chromium, wine, prism and openoffice special
+    cases still run, before the memo is looked up. Those special cases
+    read the command line or the name of the window itself, so their
+    result can't be remembered per class."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "memo" in self.__dict__:
+            return
+        self.path = os.path.join(GLib.get_user_cache_dir(),
+                                 "dockbarx", "app-memo.json")
+        self.save_sid = None
+        # identifier: [app id, desktop file path, mtime]
+        self.memo = {}
+        try:
+            with open(self.path) as f:
+                memo = json.load(f)
+            if memo.get("version") == MEMO_VERSION:
+                self.memo = memo["memo"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, identifier):
+        """Returns the remembered DesktopEntry for identifier or None."""
+        item = self.memo.get(identifier)
+        if item is None:
+            return None
+        app_id, path, mtime = item
+        try:
+            valid = os.stat(path).st_mtime == mtime and \
+                    DesktopFileIndex().get_path(app_id) == path
+        except OSError:
+            valid = False
+        if valid:
+            try:
+                return DesktopEntry(path)
+            except Exception:
+                pass
+        del self.memo[identifier]
+        self.__queue_save()
+        return None
+
+    def add(self, identifier, app_id, desktop_entry):
+        if desktop_entry is None:
+            return
+        path = desktop_entry.getFileName()
+        try:
+            item = [app_id, path, os.stat(path).st_mtime]
+        except OSError:
+            return
+        if self.memo.get(identifier) != item:
+            self.memo[identifier] = item
+            self.__queue_save()
+
+    def __queue_save(self):
+        if self.save_sid is None:
+            self.save_sid = GLib.timeout_add_seconds(MEMO_SAVE_DELAY,
+                                                     self.__save)
+
+    def __save(self):
+        self.save_sid = None
+        tmp = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"version": MEMO_VERSION, "memo": self.memo}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            logger.warning("Couldn't save %s" % self.path)
+        return False
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+#   appmatcher.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Matching of window identifiers (the lower case res_class of a window
+# or something derived from it) with applications. Everything an
+# application can be matched by is put in a dict when the application
+# is added, so a lookup is a few dict lookups no matter how many
+# applications there are.
+
+# The kinds of keys, best match first.
+ID = 0
+WM_CLASS = 1
+NAME = 2
+EXEC = 3
+NAME_WORD = 4
+KINDS = (ID, WM_CLASS, NAME, EXEC, NAME_WORD)
+
+
+def get_chromium_app(cmd):
+    """Returns the --app address of a chromium command line or None.
+
+    cmd can be a command line from a desktop file or the null separated
+    contents of /proc/PID/cmdline."""
+    if not cmd or not "--app=" in cmd:
+        return None
+    app = cmd.split("--app=", 1)[-1]
+    app = app.replace("\0", " ").split(" ", 1)[0]
+    return app.strip("\"'") or None
+
+
+class AppMatcher():
+    """An index of applications that window identifiers can be matched with.
+
+    An application is added with its id and the name, executable,
+    command line and StartupWMClass it has. The id is returned by the
+    lookups and can be anything hashable."""
+
+    def __init__(self):
+        self.indexes = dict([(kind, {}) for kind in KINDS])
+        self.chromium_apps = {}
+        # id: [(kind, key), ...] so that the app can be removed.
+        self.keys = {}
+        # The order the apps were added in, first added wins ties.
+        self.order = {}
+        self.count = 0
+
+    def __contains__(self, id):
+        return id in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, id, name=None, exe=None, cmd=None, wm_class=None):
+        if id in self.keys:
+            self.remove(id)
+        keys = []
+        keys.append((ID, id))
+        if wm_class:
+            keys.append((WM_CLASS, wm_class.lower()))
+        if name:
+            name = name.lower()
+            if " " in name:
+                # Long names like "GNU Image Manipulation Program" are
+                # matched word by word. The first word is the key.
+                words = tuple(name.split())
+                keys.append((NAME_WORD, words[0], words))
+                for i in range(1, len(words)):
+                    keys.append((NAME_WORD, words[i], words))
+            else:
+                keys.append((NAME, name))
+        if exe:
+            keys.append((EXEC, exe.rpartition("/")[-1]))
+        for key in keys:
+            self.indexes[key[0]].setdefault(key[1], []).append(id)
+        app = get_chromium_app(cmd)
+        if app:
+            self.chromium_apps.setdefault(app, []).append((id, cmd))
+            keys.append((None, app))
+        self.keys[id] = keys
+        self.order[id] = self.count
+        self.count += 1
+
+    def remove(self, id):
+        keys = self.keys.pop(id, None)
+        if keys is None:
+            return
+        self.order.pop(id, None)
+        for key in keys:
+            if key[0] is None:
+                index = self.chromium_apps
+                ids = [item for item in index.get(key[1], [])
+                       if item[0] != id]
+            else:
+                index = self.indexes[key[0]]
+                ids = [i for i in index.get(key[1], []) if i != id]
+            if ids:
+                index[key[1]] = ids
+            else:
+                index.pop(key[1], None)
+
+    def find(self, identifier):
+        """Returns the id of the best matching app or None."""
+        ids = self.find_all(identifier)
+        if ids:
+            return ids[0]
+        return None
+
+    def find_all(self, identifier):
+        """Returns the ids of all matching apps, best match first."""
+        if not identifier:
+            return []
+        matches = []
+        self.__match(identifier, matches, 0)
+        if " " in identifier:
+            # Workaround for apps with identifier like
+            # "App 1.2.3" (name with version).
+            self.__match(identifier.partition(" ")[0], matches,
+                         len(KINDS))
+        matches.sort()
+        ids = []
+        for match in matches:
+            if not match[-1] in ids:
+                ids.append(match[-1])
+        return ids
+
+    def __match(self, identifier, matches, rank):
+        for kind in (ID, WM_CLASS, NAME, EXEC):
+            for id in self.indexes[kind].get(identifier, []):
+                matches.append((rank + kind, 0, self.order[id], id))
+        words = identifier.split()
+        if not words:
+            return
+        for id in self.indexes[NAME_WORD].get(words[0], []):
+            for key in self.keys[id]:
+                if key[0] != NAME_WORD or key[1] != words[0]:
+                    continue
+                name_words = key[2]
+                if self.__contains_words(name_words, words):
+                    # The less of the name that isn't matched, the better.
+                    extra = len(name_words) - len(words)
+                    matches.append((rank + NAME_WORD, extra,
+                                    self.order[id], id))
+                    break
+
+    def __contains_words(self, name_words, words):
+        n = len(words)
+        for i in range(len(name_words) - n + 1):
+            if name_words[i:i + n] == tuple(words):
+                return True
+        return False
+
+    def find_chromium(self, identifier):
+        """Returns the id of the app for a chromium app window or None.
+
+        identifier should look like "chromium-browser-ADDRESS"."""
+        browser, sep, app = identifier.partition("-browser-")
+        if not sep:
+            return None
+        items = self.chromium_apps.get(app)
+        if not items:
+            return None
+        # Prefer apps that are started with the same browser.
+        for id, cmd in items:
+            if cmd and browser + "-browser" in cmd:
+                return id
+        return items[0][0]
@@ -210,9 +210,46 @@ class ODict():
             return False
 
 class DesktopEntry(xdg.DesktopEntry.DesktopEntry):
+    """A desktop entry with quicklist.
+
+    Parsed entries are shared by the whole process. DesktopEntry(path)
+    returns the entry that was already parsed for path unless the
+    file's modification time or size has changed since."""
+
+    # path: (mtime, size, entry)
+    cache = {}
+
+    def __new__(cls, file_name):
+        key = cls.__get_cache_key(file_name)
+        if key is not None:
+            path, mtime, size = key
+            mtime_c, size_c, entry = cls.cache.get(path, (None, None, None))
+            if entry is not None and (mtime_c, size_c) == (mtime, size):
+                return entry
+        return object.__new__(cls)
+
     def __init__(self, file_name):
+        if "quicklist" in self.__dict__:
+            # A cached entry returned by __new__.
+            return
+        # The key is taken before parsing, so that a file that changes
+        # while it's parsed is parsed again the next time.
+        key = self.__get_cache_key(file_name)
         xdg.DesktopEntry.DesktopEntry.__init__(self, file_name)
-        # Quicklist
+        self.__read_quicklist()
+        if key is not None:
+            path, mtime, size = key
+            self.cache[path] = (mtime, size, self)
+
+    @staticmethod
+    def __get_cache_key(file_name):
+        try:
+            st = os.stat(file_name)
+        except (OSError, TypeError):
+            return None
+        return (os.path.abspath(file_name), st.st_mtime, st.st_size)
+
+    def __read_quicklist(self):
         self.quicklist = ODict()
         if not "X-Ayatana-Desktop-Shortcuts" in self.content["Desktop Entry"]:
             return
@@ -592,7 +629,9 @@ class Globals(GObject.GObject):
           "show_only_current_monitor": False,
           "preview": False,
           "preview_size": 150,
+          "icon_cache_size": 16,
           "preview_minimized": True,
+          "preview_max_fps": 4,
           "old_menu": False,
           "show_close_button": True,
           "locked_list_in_menu": True,
@@ -38,6 +38,8 @@ from xdg.DesktopEntry import ParsingError
 
 
 from .common import *
+from .appindex import AppIndex, AppMemo, DesktopFileIndex
+from .appmatcher import AppMatcher, get_chromium_app
 from .log import logger
 
 from . import i18n
@@ -147,8 +149,18 @@ class Spacer(Gtk.EventBox):
         self.drag_entered = False
         
 class GroupList(list):
+    """The groups of the dock, in the order of their buttons.
+
+    The groups are indexed by identifier and desktop file path. The
+    indexes are only kept up to date if groups are added, removed and
+    changed with the methods of GroupList."""
     def __init__(self, dockbar, orient):
         list.__init__(self)
+        self.by_identifier = {}
+        self.by_path = {}
+        # While frozen, size overflow is managed once on thaw.
+        self.overflow_frozen = 0
+        self.overflow_pending = False
         self.dockbar_r = weakref.ref(dockbar)
         self.orient = orient
         self.overflow_set = 0
@@ -177,13 +189,11 @@ class GroupList(list):
         if item is None:
             raise KeyError(item)
         if isinstance(item, str):
-            for group in self:
-                if group.identifier == item or \
-                   (group.desktop_entry is not None and
-                    group.desktop_entry.getFileName() == item):
-                    return group
-            raise KeyError(item)
-        return list.__getitem__(self, item.decode())
+            group = self.by_identifier.get(item) or self.by_path.get(item)
+            if group is None:
+                raise KeyError(item)
+            return group
+        return list.__getitem__(self, item)
 
     def get(self, item, default=None):
         try:
@@ -200,24 +210,81 @@ class GroupList(list):
                 identifiers.append(group.desktop_entry.getFileName())
         return identifiers
 
+    def has_identifier(self, identifier):
+        # Same as identifier in self.get_identifiers(), but without
+        # going through all groups.
+        if identifier in self.by_identifier:
+            return True
+        group = self.by_path.get(identifier)
+        return group is not None and not group.identifier
+
+    def set_identifier(self, group, identifier):
+        self.__unindex(group)
+        try:
+            group.set_identifier(identifier)
+        finally:
+            self.__index(group)
+
+    def set_desktop_entry(self, group, desktop_entry):
+        self.__unindex(group)
+        try:
+            group.set_desktop_entry(desktop_entry)
+        finally:
+            self.__index(group)
+
+    def __get_path(self, group):
+        if group.desktop_entry is None:
+            return None
+        return group.desktop_entry.getFileName()
+
+    def __index(self, group):
+        # If two groups have the same key, the first one
+        # in the list is found, like when the list was searched.
+        for key, index in ((group.identifier, self.by_identifier),
+                           (self.__get_path(group), self.by_path)):
+            if not key:
+                continue
+            other = index.get(key)
+            if other is None or other is group or \
+               list.index(self, group) < list.index(self, other):
+                index[key] = group
+
+    def __unindex(self, group):
+        for key, index in ((group.identifier, self.by_identifier),
+                           (self.__get_path(group), self.by_path)):
+            if not key or index.get(key) is not group:
+                continue
+            del index[key]
+            # Let another group with the same key take over (rare).
+            for other in self:
+                if other is not group and \
+                   (other.identifier == key or
+                    self.__get_path(other) == key):
+                    self.__index(other)
+
     def move(self, group, index):
+        self.__unindex(group)
         list.remove(self, group)
         list.insert(self, index, group)
+        self.__index(group)
         self.container.reorder_child(group.button, index)
         self.manage_size_overflow()
         
     def append(self, group):
         list.append(self, group)
+        self.__index(group)
         self.container.pack_start(group.button, False, True, 0)
         self.manage_size_overflow()
         
     def insert(self, index, group):
         list.insert(self, index, group)
+        self.__index(group)
         self.container.pack_start(group.button, False, True, 0)
-        self.container.reorder_child(button, index)
+        self.container.reorder_child(group.button, index)
         self.manage_size_overflow()
         
     def remove(self, group):
+        self.__unindex(group)
         list.remove(self, group)
         group.destroy()
         self.manage_size_overflow()
@@ -313,7 +380,19 @@ class GroupList(list):
             groups.append(group)
         return groups
 
+    def freeze_size_overflow(self):
+        self.overflow_frozen += 1
+
+    def thaw_size_overflow(self):
+        self.overflow_frozen -= 1
+        if self.overflow_frozen == 0 and self.overflow_pending:
+            self.manage_size_overflow()
+
     def manage_size_overflow(self):
+        if self.overflow_frozen:
+            self.overflow_pending = True
+            return
+        self.overflow_pending = False
         if self.button_size <= 1:
             return
         groups = self.get_shown_groups()
@@ -440,7 +519,19 @@ class DockBar():
         self.theme = None
         self.popup_style = None
         self.skip_tasklist_windows = None
+        # Opened windows are added in batches, see __on_window_opened.
+        self.window_queue = []
+        self.window_queue_sid = None
+        self.batching_windows = False
+        self.launcher_list_pending = False
+        self.window_burst_stats = {"bursts": 0,
+                                   "windows": 0,
+                                   "last_size": 0,
+                                   "max_size": 0,
+                                   "last_time": 0.0,
+                                   "max_time": 0.0}
         self.next_group = None
+        self.active_group_r = None
         self.dockmanager = None
         self.groups = None
 
@@ -512,6 +603,8 @@ class DockBar():
         self.screen = Wnck.Screen.get_default()
         self.root_xid = int(Gdk.Screen.get_default().get_root_window().get_xid())
         self.screen.force_update()
+        Gdk.Screen.get_default().connect("monitors-changed",
+                                         self.__on_monitors_changed)
 
         # Keybord shortcut stuff
         self.gkeys = {"gkeys_select_next_group": None,
@@ -530,50 +623,14 @@ class DockBar():
             self.unity_watcher.start()
         self.globals.connect("unity-changed", self.__on_unity_changed)
         
-        # Generate Gio apps so that windows and .desktop files
-        # can be matched correctly with eachother.
-        self.apps_by_id = {}
-        self.app_ids_by_exec = {}
-        self.app_ids_by_name = {}
-        self.app_ids_by_longname = {}
-        self.app_ids_by_cmd = {}
-        self.wine_app_ids_by_program = {}
-        for app in Gio.app_info_get_all():
-            id = app.get_id()
-            id = id[:id.rfind(".")].lower()
-            #jeong89
-            name = ""+app.get_name().lower()
-            #name = u""+app.get_name().lower().decode('utf-8')
-            exe = app.get_executable()
-            if exe:
-                self.apps_by_id[id] = app
-                try:
-                    cmd = ""+app.get_commandline().lower().decode('utf-8')
-                    #cmd = u""+app.get_commandline().lower().decode('utf-8')
-                except AttributeError:
-                    # Older versions of gio doesn't have get_comandline.
-                    cmd = ""
-                    #cmd = u""
-                if id[:5] == "wine-":
-                    if cmd.find(".exe") > 0:
-                        program = cmd[:cmd.rfind(".exe")+4]
-                        program = program[program.rfind("\\")+1:]
-                        self.wine_app_ids_by_program[program] = id
-                if cmd:
-                    self.app_ids_by_cmd[cmd] = id
-                if name.find(" ")>-1:
-                    self.app_ids_by_longname[name] = id
-                else:
-                    self.app_ids_by_name[name] = id
-                if exe not in ("sudo","gksudo",
-                                "java","mono",
-                                "ruby","python"):
-                    if exe[0] == "/":
-                        exe = exe[exe.rfind("/")+1:]
-                        self.app_ids_by_exec[exe] = id
-                    else:
-                        self.app_ids_by_exec[exe] = id
-                        
+        # Index the Gio apps so that windows and .desktop files
+        # can be matched correctly with eachother. The index is
+        # built when the main loop is idle, groups get their
+        # desktop entries once it's ready.
+        self.app_index = AppIndex()
+        self.app_index.connect("changed", self.__on_apps_changed)
+        self.app_index.load()
+
         self.reload(tell_parent=False)
 
     def reload(self, event=None, data=None, tell_parent=True):
@@ -596,6 +653,10 @@ class DockBar():
             self.theme.remove()
             
         # Start building up stuff again.
+        if self.window_queue_sid is not None:
+            GLib.source_remove(self.window_queue_sid)
+            self.window_queue_sid = None
+        self.window_queue = []
         self.skip_tasklist_windows = []
         self.windows = {}
         self.globals.set_shown_popup(None)
@@ -626,11 +687,8 @@ class DockBar():
 
         #--- Initiate launchers
         self.desktop_entry_by_id = {}
-        self.d_e_ids_by_exec = {}
-        self.d_e_ids_by_name = {}
-        self.d_e_ids_by_longname = {}
+        self.launcher_matcher = AppMatcher()
         self.d_e_ids_by_wine_program = {}
-        self.d_e_ids_by_chromium_cmd = {}
 
         gconf_pinned_apps = self.globals.get_launcher_apps_from_dconf()
 
@@ -667,6 +725,7 @@ class DockBar():
         # Initiate group buttons with windows
         for window in self.screen.get_windows():
             self.__on_window_opened(self.screen, window)
+        self.__add_queued_windows()
 
         self.screen.connect("window-opened", self.__on_window_opened)
         self.screen.connect("window-closed", self.__on_window_closed)
@@ -741,10 +800,11 @@ class DockBar():
 
     def dockbar_moved(self):
         """This method should be called when dockbar has been moved"""
-        # Inform all groups about the change.
+        # Inform all groups about the change. The dock may be on
+        # another monitor now so the windows are recounted.
         if self.groups:
             for group in self.groups:
-                group.button.dockbar_moved()
+                group.dock_monitor_changed()
 
     def set_size(self, size):
         """Manualy set and update the size of group buttons"""
@@ -854,16 +914,33 @@ class DockBar():
     #### Wnck events
     def __on_active_window_changed(self, screen, previous_active_window):
         # Sets the right window button and group button active.
-        for group in self.groups:
-            group.set_active_window(None)
-        # Activate new windowbutton
+        # Only the previously active group and the new one are touched.
         active_window = screen.get_active_window()
+        active_group = None
         if active_window in self.windows:
-            active_group_name = self.windows[active_window]
-            active_group = self.groups[active_group_name]
+            active_group = self.groups.get(self.windows[active_window])
+        old_group = self.get_active_group()
+        if old_group is not None and old_group is not active_group:
+            old_group.set_active_window(None)
+        if active_group is not None:
             active_group.set_active_window(active_window)
+            self.active_group_r = weakref.ref(active_group)
+        else:
+            self.active_group_r = None
+
+    def get_active_group(self):
+        """Returns the group of the active window or None."""
+        if self.active_group_r is None:
+            return None
+        group = self.active_group_r()
+        if group is None or not group.has_active_window:
+            return None
+        return group
 
     def __on_window_closed(self, screen, window):
+        if window in self.window_queue:
+            self.window_queue.remove(window)
+            return
         if window in self.windows:
             if self.parent_window_reporting:
                 self.parent.remove_window(window)
@@ -873,6 +950,56 @@ class DockBar():
             self.skip_tasklist_windows.remove(window)
 
     def __on_window_opened(self, screen, window):
+        # Session restores and workspace switches can open many windows
+        # at once. The windows are queued and added together once the
+        # pending events have been handled.
+        self.window_queue.append(window)
+        if self.window_queue_sid is None:
+            self.window_queue_sid = GLib.idle_add(self.__add_queued_windows)
+
+    def __add_queued_windows(self):
+        if self.window_queue_sid is not None:
+            GLib.source_remove(self.window_queue_sid)
+            self.window_queue_sid = None
+        windows = self.window_queue
+        self.window_queue = []
+        if not windows:
+            return False
+        start = time()
+        # Windows of the same application are added after each other,
+        # in the order the applications' first windows were opened.
+        by_class = {}
+        for window in windows:
+            res_class = window.get_class_group().get_res_class()
+            by_class.setdefault(res_class, []).append(window)
+        self.groups.freeze_size_overflow()
+        self.batching_windows = True
+        try:
+            for class_windows in list(by_class.values()):
+                for window in class_windows:
+                    self.__open_window(window)
+        finally:
+            self.batching_windows = False
+            if self.launcher_list_pending:
+                self.update_launcher_apps_list()
+            self.groups.thaw_size_overflow()
+        # Wnck tells about a new active window before it's added.
+        if self.screen.get_active_window() in windows:
+            self.__on_active_window_changed(self.screen, None)
+        ms = (time() - start) * 1000
+        stats = self.window_burst_stats
+        stats["bursts"] += 1
+        stats["windows"] += len(windows)
+        stats["last_size"] = len(windows)
+        stats["max_size"] = max(stats["max_size"], len(windows))
+        stats["last_time"] = ms
+        stats["max_time"] = max(stats["max_time"], ms)
+        if len(windows) > 1:
+            logger.debug("Added a burst of %s windows in %.1f ms" % \
+                         (len(windows), ms))
+        return False
+
+    def __open_window(self, window):
         if not (window.get_window_type() in [Wnck.WindowType.NORMAL,
                                              Wnck.WindowType.DIALOG]):
             return
@@ -906,6 +1033,10 @@ class DockBar():
             group.desktop_changed()
 
 
+    def __on_monitors_changed(self, screen):
+        self.dockbar_moved()
+
+
     #### Groupbuttons
     def remove_groupbutton(self, group):
         self.groups.remove(group)
@@ -936,14 +1067,10 @@ class DockBar():
         group = self.groups[identifier]
         # Reset the desktop_entry in case this was
         # an custom launcher.
-        if identifier in self.wine_app_ids_by_program:
-            app_id = self.wine_app_ids_by_program[identifier]
-            app = self.apps_by_id[app_id]
-        else:
-            app = self.__find_gio_app(identifier)
+        app = self.__find_app(identifier)
         if app:
             desktop_entry = self.__get_desktop_entry_for_id(app.get_id())
-            group.set_desktop_entry(desktop_entry)
+            self.groups.set_desktop_entry(group, desktop_entry)
         group.update_name()
         self.update_launcher_apps_list()
 
@@ -993,7 +1120,7 @@ class DockBar():
                 connect(window, "name-changed",
                         self.__on_ooo_window_name_changed)
         self.windows[window] = identifier
-        if identifier in self.groups.get_identifiers():
+        if self.groups.has_identifier(identifier):
             self.groups[identifier].add_window(window)
             return
 
@@ -1014,20 +1141,20 @@ class DockBar():
             group.add_window(window)
             self.__remove_desktop_entry_id_from_list(desktop_entry_id)
         else:
-            # First window of a new group.
-            app = None
-            if wine:
-                if res_name in self.wine_app_ids_by_program:
-                    app_id = self.wine_app_ids_by_program[res_name]
-                    app = self.apps_by_id[app_id]
-            elif chromium:
-                app = self.__find_chromium_gio_app(identifier)
-            else:
-                app = self.__find_gio_app(identifier)
-            if app:
-                desktop_entry = self.__get_desktop_entry_for_id(app.get_id())
-            else:
-                desktop_entry = None
+            # First window of a new group. The memo saves the app
+            # lookup, the identifier has been worked out above.
+            desktop_entry = AppMemo().get(identifier)
+            if desktop_entry is None:
+                if wine:
+                    app = self.app_index.find_wine_app(res_name)
+                elif chromium:
+                    app = self.app_index.find_chromium_app(identifier)
+                else:
+                    app = self.app_index.find_app(identifier)
+                if app:
+                    desktop_entry = self.__get_desktop_entry_for_id(
+                                                            app.get_id())
+                    AppMemo().add(identifier, app.get_id(), desktop_entry)
             try:
                 group = self.__make_groupbutton(identifier=identifier,
                                                 desktop_entry=desktop_entry,
@@ -1046,78 +1173,34 @@ class DockBar():
         del self.windows[window]
 
     def __find_desktop_entry_id(self, identifier):
-        id = None
-        #jeong89
-        rc = ""+identifier
-        #rc = u""+identifier.lower().decode('utf-8')
-        if rc != "":
-            if rc in self.desktop_entry_by_id:
-                id = rc
-            elif rc in self.d_e_ids_by_name:
-                id = self.d_e_ids_by_name[rc]
-            elif rc in self.d_e_ids_by_exec:
-                id = self.d_e_ids_by_exec[rc]
-            else:
-                for lname in self.d_e_ids_by_longname:
-                    pos = lname.find(rc)
-                    if pos>-1: # Check that it is not part of word
-                        if rc == lname \
-                        or (pos==0 and lname[len(rc)] == " ") \
-                        or (pos+len(rc) == len(lname) \
-                        and lname[pos-1] == " ") \
-                        or (lname[pos-1] == " " and lname[pos+len(rc)] == " "):
-                            id = self.d_e_ids_by_longname[lname]
-                            break
-
-            if id is None and rc.find(" ")>-1:
-                    rc = rc.partition(" ")[0] # Cut all before space
-                    # Workaround for apps
-                    # with identifier like this "App 1.2.3" (name with ver)
-                    if rc in self.desktop_entry_by_id:
-                        id = rc
-                    elif rc in self.d_e_ids_by_name:
-                        id = self.d_e_ids_by_name[rc]
-                    elif rc in self.d_e_ids_by_exec:
-                        id = self.d_e_ids_by_exec[rc]
-        return id
-
-    def __find_gio_app(self, identifier):
-        app = None
-        app_id = None
-        rc = ""+identifier
-        if rc != "":
-            if rc in self.apps_by_id:
-                app_id = rc
-            elif rc in self.app_ids_by_name:
-                app_id = self.app_ids_by_name[rc]
-            elif rc in self.app_ids_by_exec:
-                app_id = self.app_ids_by_exec[rc]
-            else:
-                for lname in self.app_ids_by_longname:
-                    pos = lname.find(rc)
-                    if pos>-1: # Check that it is not part of word
-                        if rc == lname \
-                        or (pos==0 and lname[len(rc)] == " ") \
-                        or (pos+len(rc) == len(lname) \
-                        and lname[pos-1] == " ") \
-                        or (lname[pos-1] == " " and lname[pos+len(rc)] == " "):
-                            app_id = self.app_ids_by_longname[lname]
-                            break
-            if not app_id:
-                if rc.find(" ")>-1:
-                    rc = rc.partition(" ")[0] 
-                    # Workaround for apps
-                    # with identifier like this "App 1.2.3" (name with ver)
-                    if rc in list(self.apps_by_id.keys()):
-                        app_id = rc
-                    elif rc in list(self.app_ids_by_name.keys()):
-                        app_id = self.app_ids_by_name[rc]
-                    elif rc in list(self.app_ids_by_exec.keys()):
-                        app_id = self.app_ids_by_exec[rc]
-            if app_id:
-                app = self.apps_by_id[app_id]
+        return self.launcher_matcher.find(identifier)
+
+    def __find_app(self, identifier):
+        # Finds the Gio app of a group identifier.
+        app = self.app_index.find_wine_app(identifier)
+        if app is None and "-browser-" in identifier:
+            app = self.app_index.find_chromium_app(identifier)
+        if app is None:
+            app = self.app_index.find_app(identifier)
         return app
 
+    def __on_apps_changed(self, app_index):
+        # Groups that were made before the index was ready, or before
+        # their application was installed, get their desktop entry now.
+        if self.groups is None:
+            return
+        for group in self.groups:
+            if group.pinned or group.desktop_entry is not None or \
+               not group.identifier:
+                continue
+            app = self.__find_app(group.identifier)
+            if app is None:
+                continue
+            desktop_entry = self.__get_desktop_entry_for_id(app.get_id())
+            if desktop_entry is not None:
+                AppMemo().add(group.identifier, app.get_id(), desktop_entry)
+                self.groups.set_desktop_entry(group, desktop_entry)
+
     def __get_ooo_app_name(self, window):
         # Separates the differnt openoffice applications from each other
         # The names are chosen to match the gio app ids.
@@ -1146,32 +1229,16 @@ class DockBar():
         except:
             raise
         cmd = f.readline()
-        if "--app=" in cmd:
-            # Get the app address, remove trailing null char and remove '"'
-            app = cmd.split("--app=")[-1][:-1].translate(None, "\"")
+        f.close()
+        app = get_chromium_app(cmd)
+        if app:
             return "%s-%s" % (resclass, app)
         else:
             return resclass
 
-    def __find_chromium_gio_app(self, identifier):
-        app = identifier.split("-browser-", 1)[-1]
-        name = identifier.split("-browser-", 1)[0] + "-browser"
-        for cmd in self.app_ids_by_cmd:
-            if name in cmd and "--app=" in cmd:
-                a = str(cmd.split("--app=")[-1][:-1]).translate(None, "\"")
-                if app == a:
-                    id = self.app_ids_by_cmd[cmd]
-                    return self.apps_by_id[id]
-
     def __find_chromium_d_e_id(self, identifier):
-        app = identifier.split("-browser-", 1)[-1]
-        for cmd in self.d_e_ids_by_chromium_cmd:
-            if "--app=" in cmd:
-                a = str(cmd.split("--app=")[-1][:-1]).translate(None, "\"")
-                if app == a:
-                    return self.d_e_ids_by_chromium_cmd[cmd]
-        return None
-        
+        return self.launcher_matcher.find_chromium(identifier)
+
     def __on_ooo_window_name_changed(self, window):
         identifier = None
         for group in self.groups:
@@ -1187,9 +1254,9 @@ class DockBar():
                 self.__on_active_window_changed(self.screen, None)
 
     def __set_group_identifier(self, group, identifier):
-        group.set_identifier(identifier)
+        self.groups.set_identifier(group, identifier)
         for window in group:
-            self.windows[window.wnck] = indentifier
+            self.windows[window.wnck] = identifier
         self.update_launcher_apps_list()
         self.__media_player_check(identifier, group)
 
@@ -1207,7 +1274,7 @@ class DockBar():
         # the group button that the launcher was dropped on.
         try:
             desktop_entry = DesktopEntry(path)
-        except (Exception, detail):
+        except Exception:
             logger.exception("ERROR: Couldn't read dropped file. " + \
                              "Was it a desktop entry?")
             return False
@@ -1215,7 +1282,7 @@ class DockBar():
         # Try to match the launcher against the groups that aren't pinned.
         id = path[path.rfind("/")+1:path.rfind(".")].lower()
         #jeong89
-        name = "" + desktop_entry.getName().decode('utf-8')
+        name = "" + desktop_entry.getName().lower()
         #name = u"" + desktop_entry.getName().decode('utf-8')
         exe = desktop_entry.getExec()
         wine = False
@@ -1223,7 +1290,7 @@ class DockBar():
         if ("chromium-browser" in exe or "chrome-browser" in exe) and \
            "--app=" in exe:
             cmd = exe
-            app = cmd.split("--app=")[-1][:-1].translate(None, "\"")
+            app = get_chromium_app(cmd)
             chromium = True
         elif self.globals.settings["separate_wine_apps"] \
         and "wine" in exe and ".exe" in exe.lower():
@@ -1306,15 +1373,12 @@ class DockBar():
             self.desktop_entry_by_id[id] = desktop_entry
             if wine:
                 self.d_e_ids_by_wine_program[exe] = id
+                self.launcher_matcher.add(id)
             elif chromium:
-                self.d_e_ids_by_chromium_cmd[cmd] = id
+                self.launcher_matcher.add(id, cmd=cmd)
             else:
-                if lname:
-                    self.d_e_ids_by_longname[name] = id
-                else:
-                    self.d_e_ids_by_name[name] = id
-                if exe:
-                    self.d_e_ids_by_exec[exe] = id
+                self.launcher_matcher.add(id, name=name, exe=exe,
+                                wm_class=desktop_entry.getStartupWMClass())
 
         # Remove existing groupbutton for the same program
         window_list = []
@@ -1357,7 +1421,7 @@ class DockBar():
         if not identifier:
             return False
         window_list = []
-        if identifier in self.groups.get_identifiers():
+        if self.groups.has_identifier(identifier):
                 group = self.groups[identifier]
                 # Get the windows for repopulation of the new button
                 window_list = [window.wnck for window in group]
@@ -1394,6 +1458,11 @@ class DockBar():
 
     def update_launcher_apps_list(self, arg=None):
         # Saves pinned_apps_list to gconf.
+        if self.batching_windows:
+            # Saved once when the batch is done.
+            self.launcher_list_pending = True
+            return
+        self.launcher_list_pending = False
         gconf_pinned_apps = []
         for group in self.groups:
             if not group.launcher:
@@ -1410,8 +1479,9 @@ class DockBar():
         if path[:4] == "gio:":
             # This launcher is from an older version of dockbarx.
             # It will be updated to new form automatically.
-            if path[4:] in self.apps_by_id:
-                app = self.apps_by_id[path[4:]]
+            self.app_index.load_now()
+            if path[4:] in self.app_index.apps_by_id:
+                app = self.app_index.apps_by_id[path[4:]]
                 desktop_entry = self.__get_desktop_entry_for_id(app.get_id())
                 if desktop_entry is None:
                     return
@@ -1432,7 +1502,7 @@ class DockBar():
                 
         # Safety in case something has gone wrong and there's duplicates
         # in the list.
-        if (identifier or path) in self.groups.get_identifiers():
+        if self.groups.has_identifier(identifier or path):
             return
         try:
             self.__make_groupbutton(identifier=identifier, \
@@ -1451,10 +1521,11 @@ class DockBar():
                 # executable.
                 exe = exe[:exe.rfind(".exe")+4][exe.rfind("\\")+1:].lower()
                 self.d_e_ids_by_wine_program[exe] = id
+                self.launcher_matcher.add(id)
                 return
             elif ("chromium-browser" in exe or "chrome-browser" in exe) and \
                  "--app=" in exe:
-                self.d_e_ids_by_chromium_cmd[exe] = id
+                self.launcher_matcher.add(id, cmd=exe)
                 return
             l = exe.split()
             if l and l[0] in ("sudo","gksudo", "gksu",
@@ -1467,60 +1538,29 @@ class DockBar():
                 exe = ""
             exe = exe.rpartition("/")[-1]
             exe = exe.partition(".")[0]
-            if exe != "":
-                self.d_e_ids_by_exec[exe] = id
-
             name = "" + desktop_entry.getName().lower()
-            if name.find(" ")>-1:
-                self.d_e_ids_by_longname[name] = id
-            else:
-                self.d_e_ids_by_name[name] = id
+            self.launcher_matcher.add(id, name=name, exe=exe,
+                                wm_class=desktop_entry.getStartupWMClass())
 
     def __remove_desktop_entry_id_from_list(self, id):
         self.desktop_entry_by_id.pop(id)
-        for l in (self.d_e_ids_by_name,
-                  self.d_e_ids_by_exec,
-                  self.d_e_ids_by_longname,
-                  self.d_e_ids_by_wine_program):
-            for key, value in list(l.items()):
-                if value == id:
-                    l.pop(key)
-                    break
+        self.launcher_matcher.remove(id)
+        for key, value in list(self.d_e_ids_by_wine_program.items()):
+            if value == id:
+                self.d_e_ids_by_wine_program.pop(key)
+                break
 
     def __get_desktop_entry_for_id(self, id):
-        # Search for the desktop id first in ~/.local/share/applications
-        # and then in XDG_DATA_DIRS/applications
-        user_folder = os.environ.get("XDG_DATA_HOME",
-                                     os.path.join(os.path.expanduser("~"),
-                                                  ".local", "share"))
-        data_folders = os.environ.get("XDG_DATA_DIRS",
-                                      "/usr/local/share/:/usr/share/")
-        folders = "%s:%s"%(user_folder, data_folders)
-        for folder in folders.split(":"):
-            dirname = os.path.join(folder, "applications")
-            basename = id
-            run = True
-            while run:
-                run = False
-                path = os.path.join(dirname, basename)
-                if os.path.isfile(path):
-                    try:
-                        return DesktopEntry(path)
-                    except:
-                        pass
-                # If the desktop file is in a subfolders, the id is formated
-                # "[subfoldername]-[basename]", but there can of cource be
-                # "-" in basenames or subfoldernames as well.
-                if "-" in basename:
-                    parts = basename.split("-")
-                    for n in range(1, len(parts)):
-                        subfolder = "-".join(parts[:n])
-                        if os.path.isdir(os.path.join(dirname, subfolder)):
-                            dirname = os.path.join(dirname, subfolder)
-                            basename = "-".join(parts[n:])
-                            run = True
-                            break
-        return None
+        # The desktop file is searched for first in
+        # ~/.local/share/applications and then in
+        # XDG_DATA_DIRS/applications.
+        path = DesktopFileIndex().get_path(id)
+        if path is None:
+            return None
+        try:
+            return DesktopEntry(path)
+        except Exception:
+            return None
 
     def __identifier_dialog(self, identifier=None):
         # Input dialog for inputting the identifier.
@@ -1575,7 +1615,7 @@ class DockBar():
                 else:
                     group = self.groups[old_path]
                 group.pinned = True
-                group.set_desktop_entry(desktop_entry)
+                self.groups.set_desktop_entry(group, desktop_entry)
                 self.update_launcher_apps_list()
             return False
         return True
@@ -1808,12 +1848,7 @@ class DockBar():
         if len(self.groups) == 0:
             return
         if self.next_group is None or not (self.next_group in self.groups):
-            for group in self.groups:
-                if group.has_active_window:
-                    self.next_group = group
-                    break
-            else:
-                self.next_group = self.groups[0]
+            self.next_group = self.get_active_group() or self.groups[0]
             old_next_group = None
         else:
             old_next_group = self.next_group
@@ -1845,10 +1880,7 @@ class DockBar():
 
     def __select_next_window_in_group(self, previous=False):
         if not self.next_group:
-            for group in self.groups:
-                if group.has_active_window:
-                    self.next_group = group
-                    break
+            self.next_group = self.get_active_group()
         self.next_group.action_select_next(previous=previous,
                                            keyboard_select=True)
 
@@ -31,6 +31,7 @@ from time import time
 from time import sleep
 import os
 from xml.sax.saxutils import escape
+from Xlib import X
 import weakref
 from .windowbutton import Window
 from .iconfactory import IconFactory
@@ -42,12 +43,11 @@ from .unity import DBusMenu
 from .common import *
 from . import zg
 from .log import logger
+from .xconnection import XConnection
 
 from . import i18n
 _ = i18n.language.gettext
 
-display = None
-
 ATOM_PREVIEWS = Gdk.Atom.intern("_KDE_WINDOW_PREVIEW", True)
 
 try:
@@ -60,23 +60,32 @@ class GroupIdentifierError(Exception):
     pass
 
 class ListOfWindows(list):
+    """A list of Windows that can be looked up by wnck window or xid.
+
+    The shown, minimized and urgent windows are counted when windows are
+    added and removed, and when update_window() is called for a window
+    whose state has changed. Which windows are shown is decided by
+    is_window_shown()."""
     def __init__(self, _list=[]):
         list.__init__(self)
+        self.by_wnck = {}
+        self.by_xid = {}
+        # The counted (shown, minimized, needs attention) state by xid.
+        self.counted = {}
+        self.shown_count = 0
+        self.minimized_count = 0
+        self.attention_count = 0
         self.extend(_list)
 
     def __contains__(self, item):
         if isinstance(item, Wnck.Window):
-            return item in [window.wnck for window in self]
+            return item in self.by_wnck
         else:
             return list.__contains__(self, item)
 
     def __getitem__(self, item):
         if isinstance(item, Wnck.Window):
-            for window in self:
-                if window == item:
-                    return window
-            else:
-                raise KeyError
+            return self.by_wnck[item]
         else:
             return list.__getitem__(self, item)
 
@@ -86,37 +95,108 @@ class ListOfWindows(list):
         except KeyError:
             return default
 
+    def get_by_xid(self, xid, default=None):
+        return self.by_xid.get(xid, default)
+
+    def append(self, window):
+        list.append(self, window)
+        self.__add(window)
+
+    def insert(self, index, window):
+        list.insert(self, index, window)
+        self.__add(window)
+
+    def extend(self, windows):
+        for window in windows:
+            self.append(window)
+
+    def remove(self, window):
+        list.remove(self, window)
+        self.__remove(window)
+
+    def pop(self, index=-1):
+        window = list.pop(self, index)
+        self.__remove(window)
+        return window
+
+    def clear(self):
+        list.clear(self)
+        self.by_wnck.clear()
+        self.by_xid.clear()
+        self.counted.clear()
+        self.shown_count = 0
+        self.minimized_count = 0
+        self.attention_count = 0
+
+    def __add(self, window):
+        self.by_wnck[window.wnck] = window
+        self.by_xid[window.xid] = window
+        state = self.__get_window_state(window)
+        self.counted[window.xid] = state
+        self.__count(state, 1)
+
+    def __remove(self, window):
+        self.by_wnck.pop(window.wnck, None)
+        self.by_xid.pop(window.xid, None)
+        state = self.counted.pop(window.xid, None)
+        if state is not None:
+            self.__count(state, -1)
+
+    def __count(self, state, n):
+        shown, minimized, attention = state
+        self.shown_count += n * shown
+        self.minimized_count += n * minimized
+        self.attention_count += n * attention
+
+    def __get_window_state(self, window):
+        shown = self.is_window_shown(window)
+        return (shown, shown and window.wnck.is_minimized(),
+                bool(window.needs_attention))
+
+    def is_window_shown(self, window):
+        # Group only shows some of its windows, depending on settings.
+        return True
+
+    def update_window(self, window):
+        # Recounts the window. Returns True if the counts changed.
+        old = self.counted.get(window.xid)
+        if old is None:
+            return False
+        new = self.__get_window_state(window)
+        if new == old:
+            return False
+        self.counted[window.xid] = new
+        self.__count(old, -1)
+        self.__count(new, 1)
+        return True
+
+    def update_windows(self):
+        for window in self:
+            self.update_window(window)
+
 
     #### Get windows
     def get_windows(self):
         # Returns a list of windows that are in current use
-        windows = []
-        for window in self:
-            if self.globals.settings["show_only_current_desktop"] and \
-               not window.is_on_current_desktop():
-                continue
-            if self.globals.settings["show_only_current_monitor"] and \
-               self.get_monitor() != window.monitor:
-                continue
-            windows.append(window)
-        return ListOfWindows(windows)
+        return ListOfWindows([w for w in self if self.counted[w.xid][0]])
 
     def get_unminimized_windows(self):
-        windows = [w for w in self.get_windows() if not w.wnck.is_minimized()]
+        windows = [w for w in self if self.counted[w.xid][0] and \
+                                      not self.counted[w.xid][1]]
         return ListOfWindows(windows)
 
     def get_minimized_windows(self):
-        windows = [w for w in self.get_windows() if w.wnck.is_minimized()]
+        windows = [w for w in self if self.counted[w.xid][1]]
         return ListOfWindows(windows)
 
     def get_count(self):
-        return len(self.get_windows())
+        return self.shown_count
 
     def get_minimized_count(self):
-        return len(self.get_minimized_windows())
+        return self.minimized_count
 
     def get_unminimized_count(self):
-        return len(self.get_unminimized_windows())
+        return self.shown_count - self.minimized_count
 
 
 
@@ -147,6 +227,7 @@ class Group(ListOfWindows):
 
         # Variables
         self.has_active_window = False
+        self.active_window = None
         self.needs_attention = False
         self.nextlist = None
         self.nextlist_time = 0
@@ -171,9 +252,7 @@ class Group(ListOfWindows):
         self.root_xid = int(Gdk.Screen.get_default().get_root_window().get_xid())
         self.update_name()
 
-        self.monitor = self.get_monitor()
-        mgeo = Gdk.Screen.get_default().get_monitor_geometry(self.monitor)
-        self.monitor_aspect_ratio = float(mgeo.width) / mgeo.height
+        self.update_monitor()
 
 
         self.button = GroupButton(self)
@@ -199,6 +278,8 @@ class Group(ListOfWindows):
 
     def destroy(self):
         # Remove group button.
+        self.active_window = None
+        self.has_active_window = False
         self.remove_dockmanager()
         self.remove_media_controls()
         self.remove_launch_timer()
@@ -233,6 +314,15 @@ class Group(ListOfWindows):
         for w in self:
             w.item.set_preview(is_visible)
 
+    def is_window_shown(self, window):
+        if self.globals.settings["show_only_current_desktop"] and \
+           not window.is_on_current_desktop():
+            return False
+        if self.globals.settings["show_only_current_monitor"] and \
+           self.get_monitor() != window.monitor:
+            return False
+        return True
+
     def get_monitor(self):
         window = self.dockbar_r().groups.box.get_window()
         gdk_screen = Gdk.Screen.get_default()
@@ -241,12 +331,18 @@ class Group(ListOfWindows):
         else:
             return 0
 
+    def update_monitor(self):
+        self.monitor = self.get_monitor()
+        mgeo = Gdk.Screen.get_default().get_monitor_geometry(self.monitor)
+        self.monitor_aspect_ratio = float(mgeo.width) / mgeo.height
+
     def get_app_uri(self):
         if self.desktop_entry is not None:
             name = self.desktop_entry.getFileName().rsplit('/')[-1]
             return "application://%s" % name
 
     def desktop_changed(self):
+        self.update_windows()
         self.button.update_state()
         self.button.set_icongeo()
         self.nextlist = None
@@ -261,6 +357,20 @@ class Group(ListOfWindows):
             else:
                 self.locked_popup.hide()
 
+    def dock_monitor_changed(self):
+        # The dock has been moved or the monitors have changed. Which
+        # windows are shown depends on the monitor of the dock, so
+        # every window is recounted.
+        self.update_monitor()
+        for window in self:
+            window.monitor = window.get_monitor()
+        self.update_windows()
+        self.nextlist = None
+        self.button.update_state()
+        self.button.dockbar_moved()
+        for window in self:
+            window.item.update_show_state()
+
     def update_name(self):
         self.name = None
         if self.desktop_entry:
@@ -300,7 +410,8 @@ class Group(ListOfWindows):
         self.update_name()
         self.button.icon_factory.set_desktop_entry(desktop_entry)
         self.button.icon_factory.reset_surfaces()
-        self.button.update_state()
+        # The icon has changed even if the state hasn't.
+        self.button.update_state(force_update=True)
 
     def launch(self, button=None, event=None, uri=None, delay=0):
         if delay:
@@ -316,6 +427,7 @@ class Group(ListOfWindows):
             self.launch_timer_sid = None
 
     def __on_show_only_current_desktop_changed(self, arg):
+        self.update_windows()
         self.button.update_state()
         self.nextlist = None
         self.button.set_icongeo()
@@ -327,16 +439,13 @@ class Group(ListOfWindows):
 
     def show_launch_popup(self):
         if self.popup.window:
-            from Xlib import display, X
-            d = display.Display()
-            wnd = d.create_resource_object('window', self.get_window().get_xid())
-            ia = d.intern_atom('_KDE_WINDOW_PREVIEW', True)
-            d.close()
-            wnd.change_property(ia, 
-                                            ia, 
-                                            32, 
-                                            [0,5,0,0,0,0,0], 
-                                            X.PropModeReplace)
+            xconn = XConnection()
+            wnd = xconn.get_window(self.popup.get_window().get_xid())
+            ia = xconn.get_atom('_KDE_WINDOW_PREVIEW', True)
+            if ia:
+                wnd.change_property(ia, ia, 32, [0,5,0,0,0,0,0],
+                                    X.PropModeReplace)
+                xconn.flush()
 #            self.popup.window.property_change(ATOM_PREVIEWS,
 #                                              ATOM_PREVIEWS,
 #                                              32,
@@ -411,6 +520,9 @@ class Group(ListOfWindows):
         window = self[wnck_window]
         if window == self.scrollpeak_window:
             self.scrollpeak_abort()
+        if window is self.active_window:
+            self.active_window = None
+            self.has_active_window = False
         self.remove(window)
         if self.nextlist and window in self.nextlist:
             self.nextlist.remove(window)
@@ -437,17 +549,20 @@ class Group(ListOfWindows):
                 self.locked_popup.destroy()
 
     def set_active_window(self, wnck_window=None):
-        has_active = False
-        for window in self:
-            if window == wnck_window:
+        window = None
+        if wnck_window is not None:
+            window = self.get(wnck_window)
+        if window is not self.active_window:
+            if self.active_window is not None:
+                self.active_window.set_active(False)
+            self.active_window = window
+            if window is not None:
                 window.set_active(True)
-                has_active = True
                 if self.globals.settings["reorder_window_list"]:
                     self.remove(window)
                     self.insert(0, window)
                     self.window_list.reorder_item(0, window.item)
-            else:
-                window.set_active(False)
+        has_active = window is not None
         if has_active != self.has_active_window:
             self.has_active_window = has_active
             self.button.update_state_if_shown()
@@ -455,15 +570,8 @@ class Group(ListOfWindows):
     def needs_attention_changed(self, arg=None, state_update=True):
         # Checks if there are any urgent windows and changes
         # the group button looks if there are at least one
-        if self.unity_urgent or self.dm_attention:
-            self.needs_attention = True
-        else:
-            for window in self:
-                if window.wnck.needs_attention():
-                    self.needs_attention = True
-                    break
-            else:
-                self.needs_attention = False
+        self.needs_attention = self.unity_urgent or self.dm_attention or \
+                               self.attention_count > 0
         if state_update:
             self.button.update_state_if_shown()
 
@@ -1393,6 +1501,73 @@ class Group(ListOfWindows):
             ("no action", action_none)
             ))
 
+class StateUpdater():
+    """Coalesces the state updates of group buttons.
+
+    A single action, like switching workspace, can ask a button to update
+    its state many times. GroupButton.update_state() only marks the button
+    as dirty here and all dirty buttons are updated once, right before GTK
+    lays out and draws the next frame."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "dirty" in self.__dict__:
+            return
+        # button: force_update
+        self.dirty = {}
+        self.sid = None
+        self.requested = 0
+        self.updated = 0
+        # Requests for buttons that already were dirty.
+        self.skipped = 0
+
+    def queue(self, button, force_update=False):
+        self.requested += 1
+        if button in self.dirty:
+            self.skipped += 1
+        self.dirty[button] = self.dirty.get(button, False) or force_update
+        if self.sid is None:
+            # GTK draws frames at GDK_PRIORITY_REDRAW
+            # (PRIORITY_HIGH_IDLE + 20), this runs just before.
+            self.sid = GLib.idle_add(self.__on_idle,
+                                     priority=GLib.PRIORITY_HIGH_IDLE + 10)
+
+    def cancel(self, button):
+        self.dirty.pop(button, None)
+
+    def flush(self):
+        """Updates the dirty buttons right away."""
+        if self.sid is not None:
+            GLib.source_remove(self.sid)
+            self.sid = None
+        self.__update()
+
+    def __on_idle(self):
+        # The source is removed when this returns False.
+        self.sid = None
+        self.__update()
+        return False
+
+    def __update(self):
+        dirty = self.dirty
+        self.dirty = {}
+        for button, force_update in list(dirty.items()):
+            if button.icon_factory is None or button.group_r() is None:
+                # The button has been destroyed.
+                continue
+            self.updated += 1
+            button.update_state_now(force_update)
+
+    def get_stats(self):
+        return {"requested": self.requested,
+                "updated": self.updated,
+                "skipped": self.skipped}
+
+
 class GroupButton(CairoAppButton):
     """
     Group button takes care of a program's "button" in dockbar.
@@ -1469,6 +1644,7 @@ class GroupButton(CairoAppButton):
         if self.opacify_sid is not None:
             GLib.source_remove(self.opacify_sid)
             self.opacify_sid = None
+        StateUpdater().cancel(self)
         if self.icon_factory:
             self.icon_factory.remove()
             self.icon_factory = None
@@ -1476,6 +1652,10 @@ class GroupButton(CairoAppButton):
 
     #### State
     def update_state(self, force_update=False):
+        # The state is updated before the next frame is drawn.
+        StateUpdater().queue(self, force_update)
+
+    def update_state_now(self, force_update=False):
         # Checks button state and set the icon accordingly.
         group = self.group_r()
         window_count = min(group.get_count(), 15)
@@ -1538,6 +1718,10 @@ class GroupButton(CairoAppButton):
                 # 강제 redraw 시켜야함
                 GLib.timeout_add(30, self.queue_resize_no_redraw)
             self.update(surface)
+            if force_update:
+                # Size, theme or icon has changed. Get the states that
+                # are likely to come next ready in advance.
+                self.icon_factory.prerender(state_type)
 
     def update_state_if_shown(self, *args):
         #Update state if the button is shown.
@@ -2351,16 +2535,13 @@ class LockedPopup(GroupPopup):
                                         32, gtk.gdk.PROP_MODE_REPLACE, strut)
 
     def __get_other_strut(self, x1, x2):
-        global display
-        if display is None:
-            from Xlib import display
         monitor = self.get_screen().get_monitor_geometry(0)
         mx, my, mw, mh = monitor
-        d = display.Display()
-        root = d.screen().root
+        xconn = XConnection()
+        root = xconn.get_root()
         windows = root.query_tree()._data['children']
-        strut_atom = d.get_atom('_NET_WM_STRUT')
-        strut_partial_atom = d.get_atom('_NET_WM_STRUT_PARTIAL')
+        strut_atom = xconn.get_atom('_NET_WM_STRUT')
+        strut_partial_atom = xconn.get_atom('_NET_WM_STRUT_PARTIAL')
         strut = 0
         for w in windows:
             prop1 = w.get_full_property(strut_partial_atom, 0)
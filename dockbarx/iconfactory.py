@@ -24,25 +24,161 @@ import gi
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
+from gi.repository import GLib
 from gi.repository import GdkPixbuf
 from gi.repository import Pango
 
-import gc
-gc.enable()
-
 import os
 import weakref
-import array
+from collections import deque
 from math import pi, cos, sin
-from PIL import Image
 
 from .theme import Theme
+from .surfacecache import SurfaceCache, DiskSurfaceCache, SurfacePool
+from . import pixelops
+from .iconplan import PlanCompiler, SetValue, ZERO_SIZE, eval_size, hex_to_rgb
 from .common import Globals, connect, disconnect
 from .log import logger
 
 from . import i18n
 _ = i18n.language.gettext
 
+class IconResolver():
+    """Finds out from where named icons should be loaded.
+
+    The results, including icons that weren't found at all, are cached.
+    The cache is cleared when the icon theme changes or when something
+    changes in the pixmaps and icons folders of the XDG data dirs."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "cache" in self.__dict__:
+            return
+        self.cache = {}
+        # Increased every time the cache is cleared.
+        self.serial = 0
+        self.icon_theme = Gtk.IconTheme.get_default()
+        self.icon_theme.connect("changed", self.clear)
+        self.data_folders = []
+        self.monitors = []
+        for data_folder in get_data_folders():
+            for folder in ("pixmaps", "icons"):
+                path = os.path.join(data_folder, folder)
+                self.data_folders.append(path)
+                if not os.path.isdir(path):
+                    continue
+                try:
+                    monitor = Gio.File.new_for_path(path).monitor_directory(
+                                            Gio.FileMonitorFlags.NONE, None)
+                except GLib.GError:
+                    logger.warning("Couldn't monitor %s" % path)
+                    continue
+                monitor.connect("changed", self.clear)
+                self.monitors.append(monitor)
+
+    def clear(self, *args):
+        self.cache.clear()
+        self.serial += 1
+
+    def resolve(self, icon_name, size):
+        # Returns (theme_icon_name, path). theme_icon_name is the name
+        # to load from the icon theme or None if the icon should be
+        # loaded from path. (None, None) means that no icon was found.
+        key = (icon_name, size)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        result = self.__resolve(icon_name, size)
+        self.cache[key] = result
+        return result
+
+    def __resolve(self, icon_name, size):
+        names = [icon_name]
+        if icon_name[-4:] in (".svg", ".png", ".xpm"):
+            names.append(icon_name[:-4])
+        for name in names:
+            if self.icon_theme.has_icon(name):
+                info = self.icon_theme.lookup_icon(name, size, 0)
+                path = info.get_filename() if info is not None else None
+                return (name, path)
+        for folder in self.data_folders:
+            path = os.path.join(folder, icon_name)
+            # A file that can't be loaded doesn't hide
+            # the ones in the folders after it.
+            if os.path.isfile(path) and self.__is_loadable(path, size):
+                return (None, path)
+        return (None, None)
+
+    def __is_loadable(self, path, size):
+        try:
+            GdkPixbuf.Pixbuf.new_from_file_at_size(path, -1, size)
+        except GLib.GError:
+            return False
+        return True
+
+
+def get_data_folders():
+    data_folders = None
+
+    if "XDG_DATA_DIRS" in os.environ:
+        data_folders = os.environ["XDG_DATA_DIRS"]
+
+    if not data_folders:
+        data_folders = "/usr/local/share/:/usr/share/"
+    return data_folders.split(":")
+
+
+class IconPrerenderer():
+    """Renders icon states in advance when the main loop is idle.
+
+    Only one state is rendered per idle call so that the
+    dock stays responsive while the queue is worked off."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "queue" in self.__dict__:
+            return
+        self.queue = deque()
+        self.sid = None
+
+    def add(self, icon_factory, states):
+        # Replace anything that is queued for the icon factory already.
+        self.cancel(icon_factory)
+        ref = weakref.ref(icon_factory)
+        self.queue.extend([(ref, state) for state in states])
+        if self.sid is None:
+            self.sid = GLib.idle_add(self.__render_next,
+                                     priority=GLib.PRIORITY_LOW)
+
+    def cancel(self, icon_factory):
+        self.queue = deque([(ref, state) for (ref, state) in self.queue \
+                            if ref() not in (icon_factory, None)])
+
+    def __render_next(self):
+        while self.queue:
+            ref, state = self.queue.popleft()
+            icon_factory = ref()
+            if icon_factory is None:
+                continue
+            try:
+                icon_factory.render_in_advance(state)
+            except:
+                logger.exception("Couldn't prerender icon state %s" % state)
+            if self.queue:
+                return True
+        self.sid = None
+        return False
+
+
 class IconFactory():
     """IconFactory finds the icon for a program and prepares the cairo surface."""
     icon_theme = Gtk.IconTheme.get_default()
@@ -88,18 +224,21 @@ class IconFactory():
         self.size = 15
 
         self.icon = None
-        self.surfaces = {}
+        # Rendered surfaces are shared by all icon factories.
+        self.surfaces = SurfaceCache()
+        self.disk_cache = DiskSurfaceCache()
+        self.pool = SurfacePool()
+        self.icon_key = None
+        self.icon_file_keys = {}
+        self.colors_key = None
+        self.resolver_serial = IconResolver().serial
 
         self.average_color = None
 
         self.max_win_nr = self.theme.get_windows_cnt()
-        self.types_in_theme = 0
-        for type in self.theme.get_types():
-            if not type in self.TYPE_DICT:
-                continue
-            self.types_in_theme = self.types_in_theme | self.TYPE_DICT[type]
 
     def remove(self):
+        IconPrerenderer().cancel(self)
         del self.desktop_entry
         del self.class_group
         del self.icon
@@ -108,13 +247,17 @@ class IconFactory():
 
     def set_desktop_entry(self, desktop_entry):
         self.desktop_entry = desktop_entry
-        self.surfaces = {}
+        self.icon_key = None
+        self.icon_file_keys = {}
+        self.average_color = None
         del self.icon
         self.icon = None
 
     def set_class_group(self, class_group):
         if not self.desktop_entry and not self.class_group:
-            self.surfaces = {}
+            self.icon_key = None
+            self.icon_file_keys = {}
+            self.average_color = None
             del self.icon
             self.icon = None
         self.class_group = class_group
@@ -124,7 +267,7 @@ class IconFactory():
             # To avoid crashes.
             size = 15
         self.size = size
-        self.surfaces = {}
+        self.icon_file_keys = {}
         self.average_color = None
 
     def get_size(self):
@@ -133,8 +276,34 @@ class IconFactory():
     def get_icon(self, size):
         return self.__find_icon_pixbuf(size)
 
+    def prerender(self, state_type):
+        # Renders the states the button is likely to get next
+        # from state_type when the main loop is idle.
+        base = state_type & ~(self.MOUSE_OVER | self.MOUSE_BUTTON_DOWN |
+                              self.BLINK | self.LAUNCH_EFFECT |
+                              self.DRAG_DROPP_START | self.DRAG_DROPP_END)
+        # Ordered by how soon they are likely to be needed.
+        states = [base | self.MOUSE_OVER,
+                  base | self.MOUSE_OVER | self.MOUSE_BUTTON_DOWN]
+        if base & self.LAUNCHER:
+            states.append(base | self.LAUNCH_EFFECT)
+        else:
+            other = base ^ self.ACTIVE
+            states += [other, other | self.MOUSE_OVER]
+            minimized = base & ~(self.SOME_MINIMIZED | self.ALL_MINIMIZED)
+            if base & 15 > 1:
+                states.append(minimized | self.SOME_MINIMIZED)
+            states += [minimized | self.ALL_MINIMIZED,
+                       base | self.NEEDS_ATTENTION,
+                       base | self.NEEDS_ATTENTION | self.BLINK]
+        IconPrerenderer().add(self, states)
+
     def reset_surfaces(self, arg=None):
-        self.surfaces = {}
+        # Surfaces rendered with the old colors or icon
+        # will no longer be found in the shared cache.
+        self.icon_key = None
+        self.icon_file_keys = {}
+        self.colors_key = None
         self.average_color = None
 
 
@@ -148,35 +317,145 @@ class IconFactory():
         # Remove all types that are not used by the theme (saves memory)
         dnd = (type & self.DRAG_DROPP_START and "start") or \
               (type & self.DRAG_DROPP_END and "end")
-        type = type & self.types_in_theme
+        plan = self.__get_plan()
+        type = type & plan.types
         type += self.win_nr
         self.orient = self.dockbar_r().orient
         is_vertical = self.orient in ("left", "right")
-        if type in self.surfaces:
-            surface = self.surfaces[type]
-        else:
-            self.temp = {}
-            surface = None
-            commands = self.theme.get_icon_dict()
+        key = self.__get_cache_key(type)
+        surface = self.surfaces.get(key)
+        if surface is None:
             self.ar = self.theme.get_aspect_ratio(is_vertical)
+            self.use_size = self.__get_use_size(plan, is_vertical)
+            disk_key = self.__get_disk_cache_key(key, plan)
+            if disk_key is not None:
+                surface = self.disk_cache.get(disk_key)
+        if surface is None:
+            self.temp = {}
+            self.scratch = []
             self.type = type
-            for command, args in list(commands.items()):
-                try:
-                    f = getattr(self, "_IconFactory__command_%s"%command)
-                except:
-                    raise
-                else:
-                    surface = f(surface, **args)
+            surface = self.__run_plan(None, plan)
             # Todo: add size correction.
-            self.surfaces[type] = surface
+            self.surfaces.add(key, surface)
+            if disk_key is not None:
+                self.disk_cache.add(disk_key, surface)
+            # Give the intermediate surfaces back to the pool right away
+            # instead of leaving them for the garbage collector.
             del self.temp
-            gc.collect()
+            for scratch in self.scratch:
+                if scratch is not surface:
+                    self.pool.release(scratch)
+            del self.scratch
+        elif not key in self.surfaces:
+            # Read from the disk cache.
+            self.surfaces.add(key, surface)
         if dnd:
             surface = self.__dd_highlight(surface, is_vertical, dnd)
-            gc.collect()
         return surface
 
 
+    def render_in_advance(self, type):
+        # Renders the surface for type if it isn't in the cache already.
+        # Returns True if something was rendered.
+        plan = self.__get_plan()
+        type = (type & plan.types) + min(type & 15, self.max_win_nr)
+        self.orient = self.dockbar_r().orient
+        if self.__get_cache_key(type) in self.surfaces:
+            return False
+        self.surface_update(type)
+        return True
+
+    def __get_cache_key(self, type):
+        # The key for the shared surface cache. It needs to include
+        # everything that the rendered surface depends on.
+        resolver_serial = IconResolver().serial
+        if self.resolver_serial != resolver_serial:
+            # The icon theme or the icon folders have changed.
+            self.resolver_serial = resolver_serial
+            self.reset_surfaces()
+            del self.icon
+            self.icon = None
+        if self.icon_key is None:
+            self.icon_key = self.__get_icon_key()
+        if self.colors_key is None:
+            self.colors_key = tuple(sorted(self.globals.colors.items()))
+        return (self.theme.hash, self.icon_key, self.size,
+                self.orient, type, self.colors_key)
+
+    def __get_disk_cache_key(self, key, plan):
+        # The disk cache key is the memory cache key plus the path,
+        # load size and modification time of the icon files that the
+        # get_icon commands of the plan load. Icons that doesn't come
+        # from a file are not cached on disk.
+        file_key = self.icon_file_keys.get(self.use_size)
+        if file_key is None:
+            file_key = self.__get_icon_file_key(plan) or False
+            self.icon_file_keys[self.use_size] = file_key
+        if not file_key:
+            return None
+        return key + file_key
+
+    def __get_icon_file_key(self, plan):
+        # Resolves the icon at the sizes __command_get_icon()
+        # will load it at, so that the files are the same.
+        icon_name = self.icon_key[0]
+        if not icon_name:
+            return None
+        file_key = ()
+        for size in plan.icon_sizes:
+            size = self.__get_icon_load_size(size)
+            if os.path.isabs(icon_name):
+                path = icon_name
+            else:
+                path = IconResolver().resolve(icon_name, size)[1]
+            if not path:
+                return None
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                return None
+            file_key += (path, size, mtime)
+        return file_key
+
+    def __get_icon_key(self):
+        # Identifies the icon __find_icon_pixbuf() will find.
+        icon_name = None
+        if self.desktop_entry:
+            icon_name = self.desktop_entry.getIcon()
+        if not icon_name:
+            if self.identifier:
+                icon_name = self.identifier.lower()
+            elif self.class_group:
+                icon_name = self.class_group.get_res_class().lower()
+            # Special cases
+            if icon_name and icon_name.startswith("openoffice"):
+                icon_name = "ooo-writer"
+            if icon_name and icon_name.startswith("libreoffice"):
+                icon_name = "libreoffice-writer"
+        # The class group's icon is used if nothing else is found.
+        res_class = self.class_group and self.class_group.get_res_class()
+        return (icon_name, res_class)
+
+    def __get_plan(self):
+        # The plan is compiled once per theme load and
+        # shared by all icon factories.
+        if self.theme.icon_plan is None:
+            compiler = PlanCompiler(self.theme, self.COMMANDS, self.TYPE_DICT)
+            self.theme.icon_plan = compiler.compile()
+        return self.theme.icon_plan
+
+    def __new_surface(self, w, h):
+        # Surfaces made during a render are scratch surfaces taken from
+        # the pool. All of them but the result are released afterwards.
+        surface = self.pool.get(w, h)
+        self.scratch.append(surface)
+        return surface
+
+    def __run_plan(self, surface, plan):
+        for f, args in plan:
+            surface = f(self, surface, **args)
+        return surface
+
     def __dd_highlight(self, surface, is_vertical, position="start"):
         w = surface.get_width()
         h = surface.get_height()
@@ -242,178 +521,42 @@ class IconFactory():
         return bg
 
     def __get_color(self, color):
-        if color == "active_color":
-            color = "color5"
-        if color in ["color%s"%i for i in range(1, 9)]:
-            color = self.globals.colors[color]
+        # Returns the (r, g, b) tuple of a color parsed by the plan compiler.
+        if type(color) == tuple:
+            return color
         if color == "icon_average":
-            color = self.__get_average_color()
-        else:
-            try:
-                if len(color) != 7:
-                    raise ValueError("The string has the wrong lenght")
-                t = int(color[1:], 16)
-            except:
-                logger.exception("Theme error: the color attribute " +
-                      "for a theme command"+ \
-                      " should be a six digit hex string eg. \"#FFFFFF\" or"+ \
-                      " the a dockbarx color (\"color1\"-\"color8\").")
-                color = "#000000"
-        return color
+            return self.__get_average_color()
+        rgb = hex_to_rgb(self.globals.colors.get(color))
+        if rgb is None:
+            logger.warning("Theme error: %s can't be read." % color)
+            rgb = (0.0, 0.0, 0.0)
+        return rgb
 
     def __get_alpha(self, alpha):
         # Transparency
-        if alpha == "active_opacity":
-            # For backwards compability
-            alpha = "color5"
-
-        for i in range(1, 9):
-            if alpha in ("color%s"%i, "opacity%s"%i):
-                if ("color%s_alpha"%i) in self.globals.colors:
-                    a = float(self.globals.colors["color%s_alpha"%i])/255
-                else:
-                    logger.warning("Theme error: The theme has no" + \
-                          " opacity option for color%s." % i)
-                    a = 1.0
-                break
-        else:
-            try:
-                a = float(alpha)/100
-                if a > 1.0 or a < 0:
-                    raise
-            except:
-                logger.exception("Theme error: The opacity attribute of a theme " + \
-                      "command should be a number between \"0\" " + \
-                      " and \"100\" or \"color1\" to \"color8\".")
-                a = 1.0
-        return a
+        if type(alpha) == float:
+            return alpha
+        if alpha in self.globals.colors:
+            return float(self.globals.colors[alpha])/255
+        logger.warning("Theme error: The theme has no" + \
+              " opacity option for %s." % alpha[:-6])
+        return 1.0
 
     def __get_average_color(self):
         if self.average_color is not None:
             return self.average_color
-        r = 0
-        b = 0
-        g = 0
-        i = 0
-        im = self.__surface2pil(self.icon)
-        pixels = im.load()
-        width, height = im.size
-        for x in range(width):
-            for y in range(height):
-                pix = pixels[x, y]
-                if pix[3] > 30:
-                    i += 1
-                    r += pix[0]
-                    g += pix[1]
-                    b += pix[2]
-        if i > 0:
-            r = int(round(float(r) / i))
-            g = int(round(float(g) / i))
-            b = int(round(float(b) / i))
-        r = ("0%s"%hex(r)[2:])[-2:]
-        g = ("0%s"%hex(g)[2:])[-2:]
-        b = ("0%s"%hex(b)[2:])[-2:]
-        self.average_color = "#"+r+g+b
+        r, g, b = pixelops.average_color(self.icon)
+        self.average_color = (r / 255.0, g / 255.0, b / 255.0)
         return self.average_color
 
 
     #### Flow commands
-    def __command_if(self, surface, type=None, windows=None,
-                     size=None, orient=None, content=None):
-        if content is None:
+    def __command_if(self, surface, condition, content):
+        # The condition is parsed by the plan compiler, see iconplan.py.
+        if not condition.test(self.type, self.win_nr,
+                              self.use_size, self.orient):
             return surface
-        # TODO: complete this
-##        l = []
-##        splits = ["!", "(", ")", "&", "|"]
-##        for c in type:
-##            if c in splits:
-##                l.append(c)
-##            elif l[-1] in splits:
-##                l.append(c)
-##            elif not l:
-##                l.append(c)
-##            else:
-##                l[-1] += c
-        # Check if the type condition is satisfied
-        if type is not None:
-            negation = False
-            if type[0] == "!" :
-                type = type[1:]
-                negation = True
-            is_type = bool(type in self.TYPE_DICT \
-                      and self.type & self.TYPE_DICT[type])
-            if not (is_type ^ negation):
-                return surface
-
-        #Check if the window number condition is satisfied
-        if windows is not None:
-            arg = windows
-            negation = False
-            if arg[0] == "!" :
-                arg = windows[1:]
-                negation = True
-            if arg[0] == ":":
-                arg = "0" + arg
-            elif arg[-1] == ":":
-                arg = arg +"15"
-            l = arg.split(":", 1)
-            try:
-                l = [int(n) for n in l]
-            except ValueError:
-                logger.exception("Theme Error: The windows attribute of " + \
-                      "an <if> statement can\'t look like this:" + \
-                      " \"%s\"." % windows + \
-                      "See Theming HOWTO for more information")
-                return surface
-            if len(l) == 1:
-                if not ((l[0] == self.win_nr) ^ negation):
-                    return surface
-            else:
-                if not ((l[0]<=self.win_nr and self.win_nr<=l[1]) ^ negation):
-                    return surface
-
-        #Check if the icon size condition is satisfied
-        if size is not None:
-            arg = size
-            negation = False
-            if arg[0] == "!" :
-                arg = size[1:]
-                negation = True
-            if arg[0] == ":":
-                arg = "0" + arg
-            elif arg[-1] == ":":
-                arg = arg +"200"
-            l = arg.split(":", 1)
-            try:
-                l = [int(n) for n in l]
-            except ValueError:
-                logger.exception("Theme Error: The size attribute of " + \
-                      "an <if> statement can\'t look like this:" + \
-                      " \"%s\". See Theming HOWTO for more information" % size)
-                return surface
-            us = int(round(self.__get_use_size()))
-            if len(l) == 1:
-                if not ((l[0] == self.win_nr) ^ negation):
-                    return surface
-            else:
-                if not ((l[0]<=us and us<=l[1]) ^ negation):
-                    return surface
-
-        # Test if the orient condition is satisfied.
-        if orient is not None:
-            orients = orient.split(",")
-            if not self.orient in orients:
-                return surface
-
-        # All tests passed, proceed.
-        for command, args in list(content.items()):
-            try:
-                f = getattr(self,"_IconFactory__command_%s"%command)
-            except:
-                raise
-            else:
-                surface = f(surface, **args)
-        return surface
+        return self.__run_plan(surface, content)
 
     def __command_pixmap_from_self(self, surface, name, content=None):
         if not name:
@@ -421,51 +564,42 @@ class IconFactory():
             raise Exeption
         w = int(surface.get_width())
         h = int(surface.get_height())
-        self.temp[name] = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.temp[name] = self.__new_surface(w, h)
         ctx = cairo.Context(self.temp[name])
         ctx.set_source_surface(surface)
         ctx.paint()
         if content is None:
             return surface
-        for command,args in list(content.items()):
-            try:
-                f = getattr(self,"_IconFactory__command_%s"%command)
-            except:
-                raise
-            else:
-                self.temp[name] = f(self.temp[name], **args)
+        self.temp[name] = self.__run_plan(self.temp[name], content)
         return surface
 
     def __command_pixmap(self, surface, name, content=None, size=None):
         if size is not None:
             # TODO: Fix for different height and width
-            w = h = int(round(self.__get_use_size() + \
-                              self.__process_size(size)))
+            w = h = int(round(self.use_size + self.__process_size(size)))
         elif surface is None:
-            w = h = int(round(self.__get_use_size()))
+            w = h = int(round(self.use_size))
         else:
             w = surface.get_width()
             h = surface.get_height()
-        self.temp[name] = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.temp[name] = self.__new_surface(w, h)
         if content is None:
             return surface
-        for command,args in list(content.items()):
-            try:
-                f = getattr(self,"_IconFactory__command_%s"%command)
-            except:
-                raise
-            else:
-                self.temp[name] = f(self.temp[name], **args)
+        self.temp[name] = self.__run_plan(self.temp[name], content)
         return surface
 
     #### Get icon
-    def __command_get_icon(self,surface=None, size="0"):
-        size = int(self.__get_use_size() + self.__process_size(size))
+    def __get_icon_load_size(self, size):
+        size = int(self.use_size + self.__process_size(size))
         if size <= 0:
             # To avoid crashes.
             size = 15
         if size <=15 and size >=1:
             size = 16
+        return size
+
+    def __command_get_icon(self,surface=None, size=ZERO_SIZE):
+        size = self.__get_icon_load_size(size)
         if self.icon and\
            self.icon.get_width() == size and \
            self.icon.get_height() == size:
@@ -477,16 +611,16 @@ class IconFactory():
         if pb.get_width() != pb.get_height():
             if pb.get_width() < pb.get_height():
                 h = size
-                w = pb.get_width() * size/pb.get_height()
+                w = pb.get_width() * size//pb.get_height()
             elif pb.get_width() > pb.get_height():
                 w = size
-                h = pb.get_height() * size/pb.get_width()
+                h = pb.get_height() * size//pb.get_width()
             self.icon = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
-            ctx = gtk.gdk.CairoContext(cairo.Context(self.icon))
-            pbs = pb.scale_simple(w, h, gtk.gdk.INTERP_BILINEAR)
+            ctx = cairo.Context(self.icon)
+            pbs = pixelops.resize_surface(self.__pixbuf2surface(pb), w, h)
             woffset = round((size - w) / 2.0)
             hoffset = round((size - h) / 2.0)
-            ctx.set_source_pixbuf(pb, woffset, hoffset)
+            ctx.set_source_surface(pbs, woffset, hoffset)
             ctx.paint()
             del pb
             del pbs
@@ -537,18 +671,15 @@ class IconFactory():
             if icon_name.startswith("libreoffice"):
                 icon_name = "libreoffice-writer"
 
-        if self.icon_theme.has_icon(icon_name):
-            return self.icon_theme.load_icon(icon_name,size,0)
-
-        if icon_name[-4:] in (".svg", ".png", ".xpm"):
-            if self.icon_theme.has_icon(icon_name[:-4]):
-                pixbuf = self.icon_theme.load_icon(icon_name[:-4],size,0)
-                if pixbuf is not None:
-                    return pixbuf
-
-        pixbuf = self.__icon_search_in_data_path(icon_name, size)
-        if pixbuf is not None:
-            return pixbuf
+        theme_icon_name, path = IconResolver().resolve(icon_name, size)
+        if theme_icon_name is not None:
+            pixbuf = self.icon_theme.load_icon(theme_icon_name, size, 0)
+            if pixbuf is not None:
+                return pixbuf
+        elif path is not None:
+            pixbuf = self.__icon_from_file_name(path, size)
+            if pixbuf is not None:
+                return pixbuf
 
         if self.class_group:
             return self.class_group.get_icon().copy()
@@ -577,28 +708,6 @@ class IconFactory():
                 pass
         return None
 
-    def __icon_search_in_data_path(self, icon_name, icon_size):
-        data_folders = None
-
-        if "XDG_DATA_DIRS" in os.environ:
-            data_folders = os.environ["XDG_DATA_DIRS"]
-
-        if not data_folders:
-            data_folders = "/usr/local/share/:/usr/share/"
-
-        for data_folder in data_folders.split(":"):
-            #The line below line used datafolders instead of datafolder.
-            #I changed it because I suspect it was a bug.
-            paths = (os.path.join(data_folder, "pixmaps", icon_name),
-                     os.path.join(data_folder, "icons", icon_name))
-            for path in paths:
-                if os.path.isfile(path):
-                    icon = self.__icon_from_file_name(path, icon_size)
-                    if icon:
-                        return icon
-        return None
-
-
     #### Other commands
     def __command_clear(self, surface):
         if self.dockbar_r().orient in ("left", "right"):
@@ -607,7 +716,7 @@ class IconFactory():
         else:
             w = int(self.size * self.ar)
             h = self.size
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_rgba(0, 0, 0)
         ctx.set_operator(cairo.OPERATOR_SOURCE)
@@ -626,25 +735,22 @@ class IconFactory():
             width = surface.get_width()
             height = surface.get_height()
         if self.theme.has_surface(name):
-            surface = self.__resize_surface(self.theme.get_surface(name),
+            surface = pixelops.resize_surface(self.theme.get_surface(name),
                                             width, height)
         else:
             logger.warning("theme error: pixmap %s not found" % name)
         return surface
 
-    def __command_fill(self, surface, color, opacity="100"):
+    def __command_fill(self, surface, color, opacity=1.0):
         w = surface.get_width()
         h = surface.get_height()
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_surface(surface)
         ctx.paint()
 
         alpha = self.__get_alpha(opacity)
-        c = self.__get_color(color)
-        r = float(int(c[1:3], 16))/255
-        g = float(int(c[3:5], 16))/255
-        b = float(int(c[5:7], 16))/255
+        r, g, b = self.__get_color(color)
         ctx.set_source_rgba(r, g, b)
         ctx.set_operator(cairo.OPERATOR_SOURCE)
         ctx.paint_with_alpha(alpha)
@@ -665,7 +771,7 @@ class IconFactory():
         elif self.theme.has_surface(pix1):
             w = surface.get_width()
             h = surface.get_height()
-            p1 = self.__resize_surface(self.theme.get_surface(bg), w, h)
+            p1 = pixelops.resize_surface(self.theme.get_surface(pix1), w, h)
         else:
             logger.warning("theme error: pixmap %s not found"%pix1)
         if pix2=="self":
@@ -675,12 +781,11 @@ class IconFactory():
         elif self.theme.has_surface(pix2):
             w = surface.get_width()
             h = surface.get_height()
-            p2 = self.__resize_surface(self.theme.get_surface(bg), w, h)
+            p2 = pixelops.resize_surface(self.theme.get_surface(pix2), w, h)
         else:
             logger.warning("theme error: pixmap %s not found" % pix2)
 
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                     p1.get_width(), p1.get_height())
+        surface = self.__new_surface(p1.get_width(), p1.get_height())
         ctx = cairo.Context(surface)
 
         linear = cairo.LinearGradient(0, 0, p1.get_width(), 0)
@@ -702,55 +807,42 @@ class IconFactory():
             pass
         return surface
 
-    def __command_transp_sat(self, surface, opacity="100", saturation="100"):
+    def __command_transp_sat(self, surface, opacity=1.0, saturation=100.0):
         # Makes the icon desaturized and/or transparent.
         alpha = self.__get_alpha(opacity)
-        # Todo: Add error check for saturation
-        sat = float(saturation)
+        sat = saturation
         if sat < 100:
-            im = self.__surface2pil(surface)
-            w, h = im.size
-            pixels = im.load()
-            for x in range(w):
-                for y in range(h):
-                    r, g, b, a = pixels[x, y]
-                    l = (r + g + b) / 3.0 * (100 - sat) / 100.0
-                    r = int(r * sat / 100.0 + l)
-                    g = int(g * sat / 100.0 + l)
-                    b = int(b * sat / 100.0 + l)
-                    a = int(a * alpha)
-                    pixels[x, y] = (r, g, b, a)
-            return self.__pil2surface(im)
+            return pixelops.transp_sat(surface, sat, alpha)
         else:
             w = surface.get_width()
             h = surface.get_height()
-            new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
-            ctx = gtk.gdk.CairoContext(cairo.Context(new))
+            new = self.__new_surface(w, h)
+            ctx = cairo.Context(new)
             ctx.set_source_surface(surface)
             ctx.paint_with_alpha(alpha)
             return new
 
 
-    def __command_composite(self, surface, bg, fg, opacity="100",
-                            xoffset="0", yoffset="0", angle="0"):
+    def __command_composite(self, surface, bg, fg, opacity=1.0,
+                            xoffset=ZERO_SIZE, yoffset=ZERO_SIZE, angle=0.0):
         if fg == "self":
             foreground = surface
-            if angle and angle != "0":
+            if angle:
                 foreground = self.__command_rotate(foreground,
                                                    angle, True)
         elif fg in self.temp:
             foreground = self.temp[fg]
-            if angle and angle != "0":
+            if angle:
                 foreground = self.__command_rotate(foreground,
                                                    angle, True)
         elif self.theme.has_surface(fg):
             foreground = self.theme.get_surface(fg)
-            if angle and angle != "0":
+            if angle:
                 foreground = self.__command_rotate(foreground,
                                                    angle, True)
             w = surface.get_width()
             h = surface.get_height()
-            foreground = self.__resize_surface(foreground, w, h)
+            foreground = pixelops.resize_surface(foreground, w, h)
         else:
             logger.warning("theme error: pixmap %s not found" % fg)
             return surface
@@ -759,14 +851,14 @@ class IconFactory():
         elif bg in self.temp:
             w = self.temp[bg].get_width()
             h = self.temp[bg].get_height()
-            background = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+            background = self.__new_surface(w, h)
             ctx = cairo.Context(background)
             ctx.set_source_surface(self.temp[bg])
             ctx.paint()
         elif self.theme.has_surface(bg):
             w = surface.get_width()
             h = surface.get_height()
-            background = self.__resize_surface(self.theme.get_surface(bg), w, h)
+            background = pixelops.resize_surface(self.theme.get_surface(bg), w, h)
         else:
             logger.warning("theme error: pixmap %s not found" % bg)
             return surface
@@ -781,17 +873,17 @@ class IconFactory():
         ctx.paint_with_alpha(opacity)
         return background
 
-    def __command_shrink(self, surface, percent="0", pixels="0"):
+    def __command_shrink(self, surface, percent=0, pixels=0):
         w0 = surface.get_width()
         h0 = surface.get_height()
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w0, h0)
+        new = self.__new_surface(w0, h0)
         ctx = cairo.Context(new)
 
         pixels = self.__get_from_set(pixels)
         percent = self.__get_from_set(percent)
-        w = int(((100-int(percent)) * w0)/100)-int(pixels)
-        h = int(((100-int(percent)) * h0)/100)-int(pixels)
-        shrinked = self.__resize_surface(surface, w, h)
+        w = int(((100-percent) * w0)/100)-pixels
+        h = int(((100-percent) * h0)/100)-pixels
+        shrinked = pixelops.resize_surface(surface, w, h)
         x = round((w0 - w) / 2.0)
         y = round((h0 - h) / 2.0)
         ctx.set_source_surface(shrinked, x, y)
@@ -799,19 +891,19 @@ class IconFactory():
         del shrinked
         return new
 
-    def __command_rotate(self, surface, angle="0", resize="False"):
+    def __command_rotate(self, surface, angle=0.0, resize=False):
         w0 = surface.get_width()
         h0 = surface.get_height()
         # Check if the angle should be taken from a set.
         angle = self.__get_from_set(angle)
-        a =  float(angle)/180*pi
-        if not resize or resize in ("False", "0"):
+        a =  angle/180*pi
+        if not resize:
             w = w0
             h = h0
         else:
             w = abs(int(round(cos(a) * w0 + sin(a) * h0)))
             h = abs(int(round(cos(a) * h0 + sin(a) * w0)))
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
 
         ctx.translate(w/2.0, h/2.0)
@@ -834,13 +926,13 @@ class IconFactory():
             return surface
         woffset = round((width - surface.get_width()) / 2.0)
         hoffset = round((height - surface.get_height()) / 2.0)
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        new = self.__new_surface(width, height)
         ctx = cairo.Context(new)
         ctx.set_source_surface(surface, woffset, hoffset)
         ctx.paint()
         return new
 
-    def __command_glow(self, surface, color, opacity="100"):
+    def __command_glow(self, surface, color, opacity=1.0):
         # Adds a glow around the parts of the surface
         # that isn't completely transparent.
 
@@ -853,7 +945,7 @@ class IconFactory():
         cs = self.__command_colorize(surface, color)
         w = surface.get_width()
         h = surface.get_height()
-        glow = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        glow = self.__new_surface(w, h)
         ctx = cairo.Context(glow)
         tk1 = tk/2.0
         for x, y in ((-tk1,-tk1), (-tk1,tk1), (tk1,-tk1), (tk1,tk1)):
@@ -864,7 +956,7 @@ class IconFactory():
             ctx.paint_with_alpha(0.27)
 
         # Add glow and icon to a new canvas
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_surface(glow)
         ctx.paint_with_alpha(alpha)
@@ -876,36 +968,30 @@ class IconFactory():
         # Changes the color of all pixels to color.
         # The pixels alpha values are unchanged.
 
-        # Convert color hex-string (format "#FFFFFF")to int r, g, b
-        color = self.__get_color(color)
-        r = int(color[1:3], 16)/255.0
-        g = int(color[3:5], 16)/255.0
-        b = int(color[5:7], 16)/255.0
+        r, g, b = self.__get_color(color)
 
         w = surface.get_width()
         h = surface.get_height()
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_rgba(r,g,b,1.0)
         ctx.mask_surface(surface)
         return new
 
 
-    def __command_bright(self, surface, strength = None, strenght = None):
-        if strength is None and strenght is not None:
-            # For compability with older themes.
-            strength = strenght
+    def __command_bright(self, surface, strength=1.0):
+        # The old misspelled "strenght" is translated by the plan compiler.
         alpha = self.__get_alpha(strength)
         w = surface.get_width()
         h = surface.get_height()
         # Colorize white
-        white = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        white = self.__new_surface(w, h)
         ctx = cairo.Context(white)
         ctx.set_source_rgba(1.0, 1.0, 1.0, 1.0)
         ctx.mask_surface(surface)
         # Apply the white version over the icon
         # with the chosen alpha value
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_surface(surface)
         ctx.paint()
@@ -913,21 +999,21 @@ class IconFactory():
         ctx.paint_with_alpha(alpha)
         return new
 
-    def __command_alpha_mask(self, surface, mask, angle="0"):
+    def __command_alpha_mask(self, surface, mask, angle=0.0):
         if mask in self.temp:
             mask = self.temp[mask]
-            if angle and angle != "0":
+            if angle:
                 mask = self.__command_rotate(mask, angle, True)
         elif self.theme.has_surface(mask):
             mask = self.theme.get_surface(mask)
-            if angle and angle != "0":
+            if angle:
                 mask = self.__command_rotate(mask, angle, True)
             w = surface.get_width()
             h = surface.get_height()
-            mask = self.__resize_surface(mask, w, h)
+            mask = pixelops.resize_surface(mask, w, h)
         w = surface.get_width()
         h = surface.get_height()
-        new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        new = self.__new_surface(w, h)
         ctx = cairo.Context(new)
         ctx.set_source_surface(surface)
         ctx.mask_surface(mask)
@@ -948,75 +1034,22 @@ class IconFactory():
         del pixbuf
         return surface
 
-    def __surface2pil(self, surface):
-        w = surface.get_width()
-        h = surface.get_height()
-        data = surface.create_for_data(surface.get_data(), cairo.FORMAT_ARGB32, w, h, w * 4)
-        #im = surface.create_from_png("RGBA", (w, h), surface.get_data(), "raw", "BGRA", 0, 1)
-        return Image.frombuffer("RGBA", (w, h), surface.get_data().tobytes(),
-                                "raw", "BGRA", 0, 1)
-
-    def __pil2surface(self, im):
-        """Transform a PIL Image into a Cairo ImageSurface."""
-
-        # This function is only supposed to work with little endinan
-        # systems. Could that be a problem ever?
-        if im.mode != 'RGBA':
-            im = im.convert('RGBA')
-
-        s = im.tobytes('raw', 'BGRA')
-        a = array.array('B', s)
-        dest = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                  im.size[0], im.size[1])
-        ctx = cairo.Context(dest)
-        non_premult_src_wo_alpha = cairo.ImageSurface.create_for_data(
-            a, cairo.FORMAT_RGB24, im.size[0], im.size[1])
-        non_premult_src_alpha = cairo.ImageSurface.create_for_data(
-            a, cairo.FORMAT_ARGB32, im.size[0], im.size[1])
-        ctx.set_source_surface(non_premult_src_wo_alpha)
-        ctx.mask_surface(non_premult_src_alpha)
-        return dest
-
-    def __process_size(self, size_str):
-        us = self.__get_use_size()
-        size = 0
-        size_str = size_str.replace("-", "+-")
-        for s in size_str.split("+"):
-            if s=="":
-                continue
-            if s[-1] == "%":
-                # Rounding to whole pixels to avoid uninteded bluring.
-                size += round(float(s[:-1]) / 100 * us)
-                continue
-            if s.endswith("px"):
-                s = s[:-2]
-            # Here no rounding is done. Let's assume that the
-            # theme maker knows what he is doing if he chooses
-            # to use decimal pixel values.
-            size += float(s)
-        return size
+    def __process_size(self, size):
+        return eval_size(size, self.use_size)
 
-    def __get_use_size(self):
-        is_vertical = self.dockbar_r().orient in ("left", "right")
-        if "aspect_ratio_v" in self.theme.theme["button_pixmap"] or \
-           not is_vertical:
+    def __get_use_size(self, plan, is_vertical):
+        if plan.vertical_ar or not is_vertical:
             us = self.size * self.ar if self.ar < 1 else self.size
         else:
             # For old vertical themes
             us = self.size
         return us
 
-    def __get_from_set(self, setname):
-        s = self.theme.get_from_set(setname, self.orient)
-        if s is not None:
-            return s
-        else:
-            return setname
-
-    def __resize_surface(self, surface, w, h):
-        im = self.__surface2pil(surface)
-        im = im.resize((w, h), Image.ANTIALIAS)
-        return self.__pil2surface(im)
+    def __get_from_set(self, value):
+        # Values from sets are parsed for all orients by the plan compiler.
+        if type(value) == SetValue:
+            return value[self.orient]
+        return value
 
     def __command_print_size(self, surface):
         w = surface.get_width()
@@ -1024,4 +1057,8 @@ class IconFactory():
         return surface
 
 
-
+# Command name -> function, used by the plan compiler.
+IconFactory.COMMANDS = dict(
+    [(name[len("_IconFactory__command_"):], f) \
+     for name, f in list(vars(IconFactory).items()) \
+     if name.startswith("_IconFactory__command_")])
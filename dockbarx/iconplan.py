@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+#   iconplan.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# The button_pixmap part of a theme is a tree of commands whose arguments
+# are strings. Parsing those strings on every render is wasteful, so the
+# tree is compiled into a RenderPlan once per theme load. A plan is a list
+# of steps, each step being a tuple (function, kwargs) where all arguments
+# that can be parsed ahead of time already are.
+
+from .log import logger
+
+ORIENTS = ("up", "down", "left", "right")
+COLOR_NAMES = tuple("color%s" % i for i in range(1, 9))
+
+# A parsed size is a tuple of (percentages, pixels). See eval_size().
+ZERO_SIZE = ((), 0.0)
+
+
+class SetValue(dict):
+    """A value taken from a theme set, already parsed for every orient."""
+    pass
+
+
+class Condition():
+    """The parsed attributes of an <if> statement."""
+    __slots__ = ("mask", "type_negation", "windows", "size", "orients",
+                 "valid")
+
+    def __init__(self, type_dict, type=None, windows=None,
+                 size=None, orient=None):
+        self.valid = True
+        self.mask = None
+        self.type_negation = False
+        if type is not None:
+            if type[:1] == "!":
+                type = type[1:]
+                self.type_negation = True
+            # Unknown types never match (but their negation always does).
+            self.mask = type_dict.get(type, 0)
+        self.windows = self.__parse_range(windows, "15", "windows")
+        self.size = self.__parse_range(size, "200", "size")
+        self.orients = None
+        if orient is not None:
+            self.orients = frozenset(orient.split(","))
+
+    def __parse_range(self, value, upper, name):
+        # Returns (low, high, negation) or None.
+        if value is None:
+            return None
+        arg = value
+        negation = False
+        if arg[:1] == "!":
+            arg = arg[1:]
+            negation = True
+        if arg[:1] == ":":
+            arg = "0" + arg
+        elif arg[-1:] == ":":
+            arg = arg + upper
+        l = arg.split(":", 1)
+        try:
+            l = [int(n) for n in l]
+        except ValueError:
+            logger.exception("Theme Error: The %s attribute of " % name + \
+                  "an <if> statement can\'t look like this:" + \
+                  " \"%s\". See Theming HOWTO for more information" % value)
+            self.valid = False
+            return None
+        return (l[0], l[-1], negation)
+
+    def test(self, type, win_nr, use_size, orient):
+        if not self.valid:
+            return False
+        if self.mask is not None and \
+           not (bool(type & self.mask) ^ self.type_negation):
+            return False
+        if self.windows is not None:
+            low, high, negation = self.windows
+            if not ((low <= win_nr <= high) ^ negation):
+                return False
+        if self.size is not None:
+            low, high, negation = self.size
+            us = int(round(use_size))
+            if not ((low <= us <= high) ^ negation):
+                return False
+        if self.orients is not None and not orient in self.orients:
+            return False
+        return True
+
+
+class RenderPlan(list):
+    """A compiled button_pixmap command tree.
+
+    types is a bitmask of all state types the theme tests for and
+    icon_sizes are the parsed size arguments of its get_icon commands."""
+    def __init__(self, steps=(), types=0, vertical_ar=False, icon_sizes=()):
+        list.__init__(self, steps)
+        self.types = types
+        self.vertical_ar = vertical_ar
+        self.icon_sizes = icon_sizes
+
+
+#### Argument parsers
+def parse_color(color):
+    # Returns a (r, g, b) tuple for hex colors. Dockbarx colors and
+    # "icon_average" can change without a theme reload and are
+    # therefore kept as names that are resolved on render.
+    if color == "active_color":
+        color = "color5"
+    if color in COLOR_NAMES or color == "icon_average":
+        return color
+    rgb = hex_to_rgb(color)
+    if rgb is None:
+        logger.error("Theme error: the color attribute " +
+              "for a theme command"+ \
+              " should be a six digit hex string eg. \"#FFFFFF\" or"+ \
+              " the a dockbarx color (\"color1\"-\"color8\").")
+        rgb = (0.0, 0.0, 0.0)
+    return rgb
+
+def hex_to_rgb(color):
+    try:
+        if len(color) != 7:
+            raise ValueError("The string has the wrong lenght")
+        int(color[1:], 16)
+    except (ValueError, TypeError):
+        return None
+    return (int(color[1:3], 16) / 255.0,
+            int(color[3:5], 16) / 255.0,
+            int(color[5:7], 16) / 255.0)
+
+def parse_alpha(alpha):
+    # Returns a float for fixed opacities or the name of the
+    # globals.colors key for opacities that follows a dockbarx color.
+    if alpha == "active_opacity":
+        # For backwards compability
+        alpha = "color5"
+    for i in range(1, 9):
+        if alpha in ("color%s" % i, "opacity%s" % i):
+            return "color%s_alpha" % i
+    try:
+        a = float(alpha) / 100
+        if a > 1.0 or a < 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        logger.error("Theme error: The opacity attribute of a theme " + \
+              "command should be a number between \"0\" " + \
+              " and \"100\" or \"color1\" to \"color8\".")
+        a = 1.0
+    return a
+
+def parse_size(size_str):
+    percents = []
+    pixels = 0.0
+    for s in size_str.replace("-", "+-").split("+"):
+        if s == "":
+            continue
+        try:
+            if s[-1] == "%":
+                percents.append(float(s[:-1]))
+                continue
+            if s.endswith("px"):
+                s = s[:-2]
+            pixels += float(s)
+        except ValueError:
+            logger.error("Theme error: size \"%s\" can't be read." % size_str)
+    return (tuple(percents), pixels)
+
+def eval_size(size, use_size):
+    percents, pixels = size
+    # Rounding to whole pixels to avoid uninteded bluring.
+    # Pixel values are not rounded. Let's assume that the
+    # theme maker knows what he is doing if he chooses
+    # to use decimal pixel values.
+    return sum([round(p / 100 * use_size) for p in percents]) + pixels
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        logger.error("Theme error: \"%s\" is not an integer." % value)
+        return 0
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        logger.error("Theme error: \"%s\" is not a number." % value)
+        return 0.0
+
+def parse_bool(value):
+    return bool(value) and not value in ("False", "0")
+
+# The argument parsers for every command. Arguments with a parser
+# in SET_ARGS can also be the name of a theme set.
+ARGS = {"pixmap": {"size": parse_size},
+        "get_icon": {"size": parse_size},
+        "fill": {"color": parse_color, "opacity": parse_alpha},
+        "transp_sat": {"opacity": parse_alpha,
+                       "saturation": parse_float},
+        "composite": {"opacity": parse_alpha},
+        "glow": {"color": parse_color, "opacity": parse_alpha},
+        "colorize": {"color": parse_color},
+        "bright": {"strength": parse_alpha},
+        "rotate": {"resize": parse_bool}}
+SET_ARGS = {"composite": {"xoffset": parse_size, "yoffset": parse_size,
+                          "angle": parse_float},
+            "shrink": {"percent": parse_int, "pixels": parse_int},
+            "rotate": {"angle": parse_float},
+            "alpha_mask": {"angle": parse_float}}
+
+
+class PlanCompiler():
+    """Compiles the button_pixmap command tree of a theme to a RenderPlan.
+
+    commands is a dict of the command functions that the
+    steps of the plan should be bound to."""
+    def __init__(self, theme, commands, type_dict):
+        self.theme = theme
+        self.commands = commands
+        self.type_dict = type_dict
+
+    def compile(self):
+        self.types = 0
+        self.icon_sizes = set()
+        bp = self.theme.theme["button_pixmap"]
+        steps = []
+        if "content" in bp:
+            steps = self.__compile_content(bp["content"])
+        return RenderPlan(steps, self.types, "aspect_ratio_v" in bp,
+                          tuple(sorted(self.icon_sizes)))
+
+    def __compile_content(self, content):
+        steps = []
+        for command, args in list(content.items()):
+            if not command in self.commands:
+                logger.warning("Theme error: unknown command %s" % command)
+                continue
+            args = dict(args)
+            if command == "bright" and "strenght" in args:
+                # For compability with older themes.
+                args.setdefault("strength", args.pop("strenght"))
+            if command == "if":
+                content = args.pop("content", None)
+                if content is None:
+                    continue
+                condition = Condition(self.type_dict, **args)
+                if condition.mask:
+                    self.types |= condition.mask
+                args = {"condition": condition}
+                args["content"] = self.__compile_content(content)
+            elif "content" in args:
+                args["content"] = self.__compile_content(args["content"])
+            for key, parser in list(ARGS.get(command, {}).items()):
+                if key in args:
+                    args[key] = parser(args[key])
+            for key, parser in list(SET_ARGS.get(command, {}).items()):
+                if key in args:
+                    args[key] = self.__parse_set_value(args[key], parser)
+            if command == "get_icon":
+                self.icon_sizes.add(args.get("size", ZERO_SIZE))
+            steps.append((self.commands[command], args))
+        return steps
+
+    def __parse_set_value(self, value, parser):
+        if not value in self.theme.sets:
+            return parser(value)
+        s = self.theme.sets[value]
+        return SetValue([(orient, parser(s.get(orient, "0")))
+                         for orient in ORIENTS])
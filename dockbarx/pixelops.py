@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+#   pixelops.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pixel operations on cairo image surfaces. The pixel data is accessed
+# as numpy arrays directly in the surface buffers or handled by cairo
+# itself, so that no pixel is ever touched by the python interpreter and
+# no copies are made to other image formats. Cairo stores ARGB32 pixels
+# premultiplied in native byte order.
+
+import sys
+import cairo
+import numpy
+
+if sys.byteorder == "little":
+    R, G, B, A = 2, 1, 0, 3
+else:
+    R, G, B, A = 1, 2, 3, 0
+RGB = [R, G, B]
+
+
+def surface_array(surface):
+    """Returns a (height, width, 4) uint8 array view of an ARGB32 surface."""
+    surface.flush()
+    w = surface.get_width()
+    h = surface.get_height()
+    stride = surface.get_stride()
+    a = numpy.ndarray(shape=(h, stride // 4, 4), dtype=numpy.uint8,
+                      buffer=surface.get_data())
+    return a[:, :w]
+
+def new_surface_from_array(a):
+    """Makes a new ARGB32 surface with the pixels of a (h, w, 4) array."""
+    h, w = a.shape[:2]
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+    surface_array(surface)[...] = a
+    surface.mark_dirty()
+    return surface
+
+def transp_sat(surface, saturation=100.0, alpha=1.0):
+    """Desaturates the surface to saturation (0-100) percent and makes
+    it alpha times as opaque."""
+    px = surface_array(surface).astype(numpy.float32)
+    s = saturation / 100.0
+    rgb = px[..., RGB]
+    # Both operations are linear, which means that they give
+    # the same result on premultiplied pixels.
+    l = rgb.sum(axis=2, keepdims=True) / 3.0 * (1 - s)
+    px[..., RGB] = rgb * s + l
+    px *= alpha
+    numpy.clip(px, 0, 255, out=px)
+    return new_surface_from_array(px.astype(numpy.uint8))
+
+def average_color(surface, min_alpha=30):
+    """Returns the average (r, g, b) color, each value 0-255, of the
+    pixels that are more opaque than min_alpha."""
+    px = surface_array(surface)
+    visible = px[px[..., A] > min_alpha]
+    if not len(visible):
+        return (0, 0, 0)
+    sums = visible.sum(axis=0, dtype=numpy.uint64)
+    n = float(len(visible))
+    return tuple([int(round(sums[c] / n)) for c in RGB])
+
+def resize_surface(surface, w, h):
+    """Returns a new w x h surface with surface scaled to fit it."""
+    w = max(int(w), 0)
+    h = max(int(h), 0)
+    new = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+    sw = surface.get_width()
+    sh = surface.get_height()
+    if not (w and h and sw and sh):
+        return new
+    ctx = cairo.Context(new)
+    ctx.scale(float(w) / sw, float(h) / sh)
+    ctx.set_source_surface(surface, 0, 0)
+    pattern = ctx.get_source()
+    # FILTER_BEST makes pixman use a box filter when downscaling
+    # and EXTEND_PAD keeps the edges from fading out.
+    pattern.set_filter(cairo.FILTER_BEST)
+    pattern.set_extend(cairo.EXTEND_PAD)
+    ctx.set_operator(cairo.OPERATOR_SOURCE)
+    ctx.paint()
+    return new
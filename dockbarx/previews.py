@@ -0,0 +1,455 @@
+#!/usr/bin/python3
+
+#   previews.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import weakref
+from collections import OrderedDict
+from time import time
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+from Xlib import X
+from Xlib import display
+from Xlib import error
+try:
+    from Xlib.ext import damage
+except ImportError:
+    # Older python-xlib without the DAMAGE extension.
+    damage = None
+from PIL import Image
+
+from .common import Globals
+from .xconnection import XConnection
+from .xshm import ShmImageReader
+from .log import logger
+
+# The most memory the cached thumbnails may use, in bytes.
+MAX_CACHE_SIZE = 32 * 1024 * 1024
+# The most memory the snapshots of minimized windows may use, in bytes.
+MAX_SNAPSHOTS_SIZE = 16 * 1024 * 1024
+MAX_MINIMIZED_ICONS = 64
+# Seconds a window is still watched for changes after its preview
+# was hidden, so that reopening the popup needs no new capture.
+WATCH_TIME = 60
+DEFAULT_MAX_FPS = 4
+
+
+class PreviewCache():
+    """Captures window previews in a worker thread and caches them.
+
+    The worker thread has an X connection of its own (python-xlib
+    connections can't be shared between threads). It captures the
+    window, through MIT-SHM when the X server allows it, scales it and
+    hands the pixels over to the main loop where the thumbnail is
+    cached by xid and size and given to the one who asked for it. The
+    least recently used thumbnails are dropped when the cache grows
+    bigger than MAX_CACHE_SIZE.
+
+    If the X server has the DAMAGE extension, the windows of shown
+    previews are watched for changes. A watched window is only captured
+    again when it has changed, and then at most preview_max_fps times
+    per second. Without DAMAGE a window is captured every time its
+    preview is requested.
+
+    The pixmap of a minimized window is usually gone, so the last
+    capture of a window is kept as a snapshot when it's minimized. The
+    faded icons of minimized windows are cached here too."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "thumbnails" in self.__dict__:
+            return
+        self.globals = Globals()
+        # (xid, width, height): pixbuf, least recently used first.
+        self.thumbnails = OrderedDict()
+        self.cache_size = 0
+        # xid: the newest thumbnail, while it's cached.
+        self.newest = {}
+        # xid: (width, height, weak callback) of the shown previews.
+        self.wanted = {}
+        # Bumped when a window is forgotten, so that a capture
+        # that was on its way is thrown away.
+        self.generations = {}
+        # xid: (width, height, generation) for the worker.
+        self.jobs = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # xid: damage of the watched windows.
+        self.damages = {}
+        # Watched windows that have changed since they were captured.
+        self.damaged = set()
+        self.unwatch_sids = {}
+        self.capture_sids = {}
+        self.capture_times = {}
+        self.damage_event = None
+
+        # xid: pixbuf, the last capture of minimized windows.
+        self.snapshots = OrderedDict()
+        self.snapshots_size = 0
+        # (app, width, height): faded icon, least recently used first.
+        self.minimized_icons = OrderedDict()
+
+    def get(self, xid, width, height):
+        """Returns the cached thumbnail or None."""
+        key = (xid, width, height)
+        pixbuf = self.thumbnails.get(key)
+        if pixbuf is not None:
+            self.thumbnails.move_to_end(key)
+        return pixbuf
+
+    def get_any(self, xid, width, height):
+        """Returns a thumbnail of the window at the asked size or None.
+
+        If there is no thumbnail of that size, one of another size
+        is scaled."""
+        pixbuf = self.get(xid, width, height)
+        if pixbuf is not None:
+            return pixbuf
+        for key, pixbuf in reversed(self.thumbnails.items()):
+            if key[0] == xid:
+                return pixbuf.scale_simple(width, height,
+                                           GdkPixbuf.InterpType.BILINEAR)
+        return None
+
+    def request(self, xid, width, height, callback):
+        """Asks for the preview of the window until cancel() is called.
+
+        callback(pixbuf) is called from the main loop when a thumbnail
+        is ready and, if the window is watched, every time the window
+        has changed and been captured again. Only a weak reference to
+        callback is kept. A new request for the same window replaces
+        the old one."""
+        self.wanted[xid] = (width, height, weakref.WeakMethod(callback))
+        self.__watch(xid)
+        if xid in self.damages and not xid in self.damaged and \
+           (xid, width, height) in self.thumbnails:
+            # The window hasn't changed since it was captured.
+            return
+        self.__capture(xid)
+
+    def cancel(self, xid):
+        """Stops giving previews of the window to the one who asked."""
+        self.wanted.pop(xid, None)
+        with self.condition:
+            self.jobs.pop(xid, None)
+        sid = self.capture_sids.pop(xid, None)
+        if sid is not None:
+            GLib.source_remove(sid)
+        if xid in self.damages and not xid in self.unwatch_sids:
+            self.unwatch_sids[xid] = GLib.timeout_add_seconds(
+                                        WATCH_TIME, self.__unwatch, xid)
+
+    def forget(self, xid):
+        """Drops everything about the window, call it when it's closed."""
+        self.cancel(xid)
+        self.__unwatch(xid)
+        self.capture_times.pop(xid, None)
+        self.drop_snapshot(xid)
+        self.generations[xid] = self.generations.get(xid, 0) + 1
+        for key in [key for key in self.thumbnails if key[0] == xid]:
+            self.__uncache(key)
+
+    def keep_snapshot(self, xid):
+        """Keeps the last capture of the window until drop_snapshot().
+
+        Call it when the window is minimized. The oldest snapshots are
+        dropped when they use more than MAX_SNAPSHOTS_SIZE."""
+        pixbuf = self.newest.get(xid)
+        if pixbuf is None:
+            return
+        self.drop_snapshot(xid)
+        self.snapshots[xid] = pixbuf
+        self.snapshots_size += get_pixbuf_size(pixbuf)
+        while self.snapshots_size > MAX_SNAPSHOTS_SIZE and \
+              len(self.snapshots) > 1:
+            self.drop_snapshot(next(iter(self.snapshots)))
+
+    def get_snapshot(self, xid, width, height):
+        """Returns the snapshot of the window at the asked size or None."""
+        pixbuf = self.snapshots.get(xid)
+        if pixbuf is None:
+            return None
+        self.snapshots.move_to_end(xid)
+        if pixbuf.get_width() != width or pixbuf.get_height() != height:
+            pixbuf = pixbuf.scale_simple(width, height,
+                                         GdkPixbuf.InterpType.BILINEAR)
+        return pixbuf
+
+    def drop_snapshot(self, xid):
+        pixbuf = self.snapshots.pop(xid, None)
+        if pixbuf is not None:
+            self.snapshots_size -= get_pixbuf_size(pixbuf)
+
+    def get_minimized_icon(self, app, icon):
+        """Returns a faded and desaturated copy of icon.
+
+        app should be the same for all windows that have the same icon,
+        like the identifier of their group. The copy is made once for
+        every app and icon size."""
+        key = (app, icon.get_width(), icon.get_height())
+        pixbuf = self.minimized_icons.get(key)
+        if pixbuf is not None:
+            self.minimized_icons.move_to_end(key)
+            return pixbuf
+        pixbuf = make_minimized_icon(icon)
+        self.minimized_icons[key] = pixbuf
+        if len(self.minimized_icons) > MAX_MINIMIZED_ICONS:
+            self.minimized_icons.popitem(last=False)
+        return pixbuf
+
+    def drop_minimized_icons(self, app):
+        """Drops the faded icons of app, call it when its icon changes."""
+        for key in [key for key in self.minimized_icons if key[0] == app]:
+            del self.minimized_icons[key]
+
+    def __capture(self, xid):
+        wanted = self.wanted.get(xid)
+        if wanted is None:
+            return
+        if xid in self.damages:
+            # Changes from now on make the damage non-empty again
+            # and are reported with a new DamageNotify.
+            xconn = XConnection()
+            try:
+                xconn.get_display().damage_subtract(self.damages[xid],
+                                                    X.NONE, X.NONE)
+                xconn.flush()
+            except error.ConnectionClosedError:
+                pass
+            self.damaged.discard(xid)
+        self.capture_times[xid] = time()
+        width, height = wanted[:2]
+        with self.condition:
+            self.jobs[xid] = (width, height, self.generations.get(xid, 0))
+            self.condition.notify()
+            # The thread clears self.thread and checks the jobs that
+            # are left holding the condition, so a job is never queued
+            # to a thread that has stopped taking jobs.
+            if self.thread is None:
+                self.__start_thread()
+
+    def __start_thread(self):
+        # Must be called with self.condition held.
+        self.thread = threading.Thread(target=self.__work,
+                                       name="dockbarx-previews")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __cache(self, key, pixbuf):
+        if key in self.thumbnails:
+            self.__uncache(key)
+        self.thumbnails[key] = pixbuf
+        self.cache_size += get_pixbuf_size(pixbuf)
+        while self.cache_size > MAX_CACHE_SIZE and len(self.thumbnails) > 1:
+            self.__uncache(next(iter(self.thumbnails)))
+
+    def __uncache(self, key):
+        pixbuf = self.thumbnails.pop(key)
+        if self.newest.get(key[0]) is pixbuf:
+            del self.newest[key[0]]
+        self.cache_size -= get_pixbuf_size(pixbuf)
+
+    def __deliver(self, xid, width, height, generation, data):
+        if generation != self.generations.get(xid, 0):
+            return False
+        pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+                                                 GdkPixbuf.Colorspace.RGB,
+                                                 True, 8, width, height,
+                                                 width * 4)
+        self.__cache((xid, width, height), pixbuf)
+        self.newest[xid] = pixbuf
+        wanted = self.wanted.get(xid)
+        if wanted is None or wanted[:2] != (width, height):
+            return False
+        if not xid in self.damages:
+            # Nothing tells when the window changes,
+            # the next request captures it again.
+            del self.wanted[xid]
+        callback = wanted[2]()
+        if callback is not None:
+            callback(pixbuf)
+        return False
+
+    #### Damage
+    def __watch(self, xid):
+        sid = self.unwatch_sids.pop(xid, None)
+        if sid is not None:
+            GLib.source_remove(sid)
+        if xid in self.damages or not self.__has_damage():
+            return
+        xconn = XConnection()
+        try:
+            self.damages[xid] = xconn.get_window(xid).damage_create(
+                                            damage.DamageReportNonEmpty)
+            xconn.flush()
+        except error.ConnectionClosedError:
+            return
+        # What changed before the damage was created is unknown.
+        self.damaged.add(xid)
+
+    def __unwatch(self, xid):
+        sid = self.unwatch_sids.pop(xid, None)
+        if sid is not None:
+            GLib.source_remove(sid)
+        self.damaged.discard(xid)
+        damage_id = self.damages.pop(xid, None)
+        if damage_id is not None:
+            xconn = XConnection()
+            try:
+                # Gives a harmless error if the window is already gone.
+                xconn.get_display().damage_destroy(damage_id)
+                xconn.flush()
+            except error.ConnectionClosedError:
+                pass
+        return False
+
+    def __has_damage(self):
+        if self.damage_event is not None:
+            return True
+        if damage is None:
+            return False
+        xconn = XConnection()
+        d = xconn.get_display()
+        if not xconn.has_extension(damage.extname):
+            return False
+        d.damage_query_version()
+        self.damage_event = d.extension_event.DamageNotify
+        xconn.add_event_handler(self.damage_event, self.__on_damage)
+        return True
+
+    def __on_damage(self, event):
+        xid = getattr(event.drawable, "id", event.drawable)
+        if not xid in self.damages:
+            return
+        # The damage is subtracted when the window is captured,
+        # until then there are no more events about it.
+        self.damaged.add(xid)
+        if xid in self.wanted and not xid in self.capture_sids:
+            fps = self.globals.settings.get("preview_max_fps",
+                                            DEFAULT_MAX_FPS)
+            interval = 1.0 / max(fps, 1)
+            delay = self.capture_times.get(xid, 0) + interval - time()
+            delay = int(max(delay, 0) * 1000)
+            self.capture_sids[xid] = GLib.timeout_add(delay,
+                                                      self.__on_capture_due,
+                                                      xid)
+
+    def __on_capture_due(self, xid):
+        self.capture_sids.pop(xid, None)
+        if xid in self.damaged:
+            self.__capture(xid)
+        return False
+
+    #### The worker thread
+    def __work(self):
+        restart = False
+        try:
+            self.__capture_jobs()
+            # The X connection was lost, a new thread opens a new one.
+            restart = True
+        except Exception:
+            logger.exception("The preview thread couldn't go on.")
+        finally:
+            with self.condition:
+                self.thread = None
+                # After an unexpected error the jobs that are left
+                # wait for the next capture to start a new thread.
+                if restart and self.jobs:
+                    self.__start_thread()
+
+    def __capture_jobs(self):
+        d = display.Display()
+        # Errors about windows that are already gone are expected.
+        d.set_error_handler(lambda *args: None)
+        shm = ShmImageReader()
+        try:
+            while True:
+                with self.condition:
+                    while not self.jobs:
+                        self.condition.wait()
+                    xid, (width, height, generation) = \
+                                                self.jobs.popitem(last=False)
+                try:
+                    image = shm.get_image(xid)
+                    if image is None:
+                        image = get_image(d, xid)
+                    data = scale_bgra(image[0], image[1], image[2],
+                                      width, height)
+                except error.ConnectionClosedError:
+                    logger.warning("The preview thread lost " + \
+                                   "its X connection.")
+                    return
+                except (error.XError, ValueError):
+                    # The window is gone or can't be captured right now.
+                    continue
+                except Exception:
+                    logger.exception("Couldn't capture the preview " + \
+                                     "of window %s" % xid)
+                    continue
+                GLib.idle_add(self.__deliver, xid, width, height,
+                              generation, data)
+        finally:
+            shm.close()
+            try:
+                d.close()
+            except error.ConnectionClosedError:
+                pass
+
+
+def get_pixbuf_size(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+def make_minimized_icon(icon):
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True,
+                                  8, icon.get_width(),
+                                  icon.get_height())
+    pixbuf.fill(0x00000000)
+    minimized_icon = pixbuf.copy()
+    icon.composite(pixbuf, 0, 0, pixbuf.get_width(),
+                   pixbuf.get_height(), 0, 0, 1, 1,
+                   GdkPixbuf.InterpType.BILINEAR, 190)
+    pixbuf.saturate_and_pixelate(minimized_icon, 0.12, False)
+    return minimized_icon
+
+def get_image(d, drawable):
+    """Returns (BGRA pixels, width, height) of a window or pixmap.
+
+    The pixels are sent over the X connection of the python-xlib
+    display d, this is used when MIT-SHM isn't available."""
+    drawable = d.create_resource_object("window", drawable)
+    geo = drawable.get_geometry()
+    di = drawable.get_image(0, 0, geo.width, geo.height,
+                            X.ZPixmap, 0xffffffff)
+    return di.data, geo.width, geo.height
+
+def scale_bgra(pixels, width, height, to_width, to_height):
+    """Scales BGRA pixels and returns them as RGBA bytes.
+
+    The pixels are used where they are, without a copy. The scaling
+    is done before the channels are swapped, so the scaled image is
+    the only big allocation."""
+    img = Image.frombuffer("RGBA", (width, height), pixels,
+                           "raw", "RGBA", 0, 1)
+    b, g, r, a = img.resize((to_width, to_height), Image.BILINEAR).split()
+    return Image.merge("RGBA", (r, g, b, a)).tobytes()
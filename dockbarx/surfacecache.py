@@ -0,0 +1,333 @@
+#!/usr/bin/python3
+
+#   surfacecache.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import time
+import struct
+import hashlib
+from collections import OrderedDict
+
+import cairo
+from gi.repository import GLib
+
+from .common import Globals, connect
+from .log import logger
+
+# Used if the setting is missing from an old installed schema.
+DEFAULT_MAX_SIZE = 16   # MiB
+
+# Disk cache file header: magic, version, width, height, stride.
+# It's padded to 32 bytes to keep the pixel data aligned.
+DISK_HEADER = struct.Struct("=4sIIII12x")
+DISK_MAGIC = b"DBXS"
+DISK_VERSION = 1
+# Files that haven't been used for this many days are removed.
+DISK_MAX_AGE = 30
+DISK_MAX_SIZE = 64 * 1024 * 1024
+
+
+class SurfaceCache():
+    """A process wide LRU cache for rendered icon surfaces.
+
+    The keys are made by IconFactory and contain everything that the
+    rendered surface depends on, so buttons with the same icon, size and
+    state share their surfaces. The size of the cache is limited by the
+    icon_cache_size setting (in MiB)."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "surfaces" in self.__dict__:
+            return
+        self.surfaces = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.globals = Globals()
+        self.__update_max_size()
+        connect(self.globals, "preference-update", self.__update_max_size)
+
+    def __update_max_size(self, *args):
+        mib = self.globals.settings.get("icon_cache_size", DEFAULT_MAX_SIZE)
+        self.max_size = max(mib, 0) * 1024 * 1024
+        self.__shrink()
+
+    def __contains__(self, key):
+        return key in self.surfaces
+
+    def get(self, key):
+        try:
+            surface = self.surfaces[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.surfaces.move_to_end(key)
+        self.hits += 1
+        return surface
+
+    def add(self, key, surface):
+        if surface is None:
+            return
+        if key in self.surfaces:
+            self.memory -= self.__get_surface_size(self.surfaces.pop(key))
+        self.surfaces[key] = surface
+        self.memory += self.__get_surface_size(surface)
+        self.__shrink()
+
+    def clear(self):
+        self.surfaces.clear()
+        self.memory = 0
+
+    def get_stats(self):
+        return {"entries": len(self.surfaces),
+                "memory": self.memory,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses}
+
+    def __shrink(self):
+        # Remove the least recently used surfaces until the cache
+        # fits in max_size. The newest surface is always kept.
+        while self.memory > self.max_size and len(self.surfaces) > 1:
+            key, surface = self.surfaces.popitem(last=False)
+            self.memory -= self.__get_surface_size(surface)
+
+    def __get_surface_size(self, surface):
+        try:
+            return surface.get_stride() * surface.get_height()
+        except AttributeError:
+            logger.warning("SurfaceCache: %s is not an image surface" % \
+                           surface)
+            return 0
+
+
+class SurfacePool():
+    """Scratch surfaces that can be reused between icon renders.
+
+    Released surfaces are kept by size and handed out again, cleared,
+    by get(). At most max_surfaces surfaces are kept, the sizes that
+    were least recently used are dropped first."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self, max_surfaces=32):
+        if "free" in self.__dict__:
+            return
+        self.free = OrderedDict()
+        self.count = 0
+        self.max_surfaces = max_surfaces
+
+    def get(self, w, h):
+        w = max(int(w), 0)
+        h = max(int(h), 0)
+        surfaces = self.free.get((w, h))
+        if not surfaces:
+            return cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.free.move_to_end((w, h))
+        self.count -= 1
+        surface = surfaces.pop()
+        ctx = cairo.Context(surface)
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
+        ctx.paint()
+        return surface
+
+    def release(self, surface):
+        # The surface must not be used by the caller after this.
+        try:
+            size = (surface.get_width(), surface.get_height())
+        except AttributeError:
+            return
+        self.free.setdefault(size, []).append(surface)
+        self.free.move_to_end(size)
+        self.count += 1
+        while self.count > self.max_surfaces:
+            size, surfaces = next(iter(self.free.items()))
+            surfaces.pop(0).finish()
+            self.count -= 1
+            if not surfaces:
+                del self.free[size]
+
+    def clear(self):
+        for surfaces in list(self.free.values()):
+            for surface in surfaces:
+                surface.finish()
+        self.free.clear()
+        self.count = 0
+
+
+class DiskSurfaceCache():
+    """A persistent cache of rendered surfaces.
+
+    Every surface is stored as raw ARGB32 data in a file of its own under
+    the user cache directory. The files are memory mapped when read, so
+    that a cold start doesn't need to render or decode anything. The keys
+    must contain everything the surface depends on, a changed input gives
+    a new key and the old file is eventually pruned as unused. New files
+    are written one at a time when the main loop is idle, so that a theme
+    change doesn't block the dock with a write for every surface."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "path" in self.__dict__:
+            return
+        self.path = os.path.join(GLib.get_user_cache_dir(),
+                                 "dockbarx", "surfaces")
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError:
+            logger.warning("Can't create surface cache directory %s" % \
+                           self.path)
+            self.enabled = False
+        else:
+            self.enabled = True
+            # path: surface, the files that are waiting to be written.
+            self.pending = OrderedDict()
+            self.write_sid = None
+            # Prune old files once the dock has started.
+            GLib.timeout_add_seconds(60, self.__prune)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self.__get_path(key)
+        if path in self.pending:
+            return self.pending[path]
+        try:
+            with open(path, "rb") as f:
+                # ACCESS_COPY gives a private writable mapping
+                # that cairo can use as its pixel buffer.
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return None
+        try:
+            magic, version, w, h, stride = DISK_HEADER.unpack_from(mm)
+        except struct.error:
+            return None
+        if magic != DISK_MAGIC or version != DISK_VERSION or \
+           len(mm) != DISK_HEADER.size + stride * h:
+            return None
+        try:
+            surface = cairo.ImageSurface.create_for_data(
+                            memoryview(mm)[DISK_HEADER.size:],
+                            cairo.FORMAT_ARGB32, w, h, stride)
+        except (cairo.Error, ValueError):
+            logger.exception("Couldn't read cached surface %s" % path)
+            return None
+        try:
+            # Mark the file as used.
+            os.utime(path)
+        except OSError:
+            pass
+        return surface
+
+    def add(self, key, surface):
+        if not self.enabled or surface is None:
+            return
+        self.pending[self.__get_path(key)] = surface
+        if self.write_sid is None:
+            self.write_sid = GLib.idle_add(self.__write_next,
+                                           priority=GLib.PRIORITY_LOW)
+
+    def __write_next(self):
+        if not self.pending:
+            self.write_sid = None
+            return False
+        path, surface = self.pending.popitem(last=False)
+        self.__write(path, surface)
+        if self.pending:
+            return True
+        self.write_sid = None
+        return False
+
+    def __write(self, path, surface):
+        tmp = "%s.%s.tmp" % (path, os.getpid())
+        surface.flush()
+        header = DISK_HEADER.pack(DISK_MAGIC, DISK_VERSION,
+                                  surface.get_width(), surface.get_height(),
+                                  surface.get_stride())
+        try:
+            with open(tmp, "wb") as f:
+                f.write(header)
+                f.write(surface.get_data())
+            # Replacing makes the write atomic for other dock processes.
+            os.replace(tmp, path)
+        except OSError:
+            logger.warning("Couldn't write surface cache file %s" % path)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def clear(self):
+        if not self.enabled:
+            return
+        self.pending.clear()
+        for name in os.listdir(self.path):
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def __get_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, name)
+
+    def __prune(self):
+        # Removes files that haven't been used for a long time and
+        # the least recently used ones if the cache is too big.
+        files = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return False
+        now = time.time()
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > DISK_MAX_AGE * 24 * 3600:
+                self.__remove(path)
+            else:
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        size = sum([f[1] for f in files])
+        while files and size > DISK_MAX_SIZE:
+            mtime, fsize, path = files.pop(0)
+            self.__remove(path)
+            size -= fsize
+        return False
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
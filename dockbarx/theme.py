@@ -28,11 +28,12 @@ from gi.repository import Gtk
 from gi.repository import GObject
 
 import os
-import array
+import hashlib
 from .common import ODict
 from .common import Globals
 from .log import logger
-from PIL import Image
+from . import pixelops
+from . import themecache
 
 from . import i18n
 _ = i18n.language.gettext
@@ -95,7 +96,7 @@ class ThemeHandler(ContentHandler):
 
     def __add_to_types(self, type):
         if type[0] == "!":
-            type == type[1:]
+            type = type[1:]
         if not type in self.types:
             self.types.append(type)
 
@@ -162,12 +163,10 @@ class Theme(GObject.GObject):
                 for f in os.listdir(dir):
                     if f[-7:] == ".tar.gz":
                         theme_paths.append(dir+"/"+f)
+        catalog = themecache.ThemeCatalog()
+        checked = catalog.check_files("theme", theme_paths, self.check)
         for theme_path in theme_paths:
-            try:
-                name = self.check(theme_path)
-            except Exception as detail:
-                logger.exception("Error loading theme from %s"%theme_path)
-                name = None
+            name = checked.get(theme_path)
             if name is not None:
                 name = str(name)
                 themes[name] = theme_path
@@ -185,32 +184,20 @@ class Theme(GObject.GObject):
         return themes
 
     def reload(self):
-        tar = taropen(self.theme_path)
-        for member in tar.getmembers():
-            if member.name == "config":
-                config = tar.extractfile(member)
-                break
-
-        # Parse
-        parser = make_parser()
-        theme_handler = ThemeHandler()
-        parser.setContentHandler(theme_handler)
-        parser.parse(config)
-        self.theme = theme_handler.get_dict()
-
-        # Name
-        self.name = theme_handler.get_name()
-
-        self.types = theme_handler.get_types()
-
-        # Pixmaps
-        self.surfaces = {}
-        pixmaps = {}
-        if self.theme.has_key("pixmaps"):
-            pixmaps = self.theme["pixmaps"]["content"]
-        for (type_, d) in list(pixmaps.items()):
-            if type_ == "pixmap_from_file":
-                self.surfaces[d["name"]] = self.load_surface(tar, d["file"])
+        compiled = themecache.load(self.theme_path, "theme")
+        if compiled is None:
+            self.__load_tar()
+            data = {"theme": themecache.odict_to_list(self.theme),
+                    "name": self.name,
+                    "types": self.types,
+                    "hash": self.hash}
+            themecache.save(self.theme_path, "theme", data, self.surfaces)
+        else:
+            data, self.surfaces = compiled
+            self.theme = themecache.list_to_odict(data["theme"])
+            self.name = data["name"]
+            self.types = data["types"]
+            self.hash = data["hash"]
 
         # Popup style
         ps = self.theme.get("popup_style", {})
@@ -259,8 +246,8 @@ class Theme(GObject.GObject):
         for (type_, d) in list(sets.items()):
             if type_ == "set":
                 self.sets[d["name"]] = d
-        config.close()
-        tar.close()
+        # The render plan is compiled by IconFactory when first needed.
+        self.icon_plan = None
         # Inform rest of dockbar about the reload.
         self.globals.theme_name = self.name
         self.globals.update_colors(self.name,
@@ -268,6 +255,39 @@ class Theme(GObject.GObject):
         self.globals.update_popup_style(self.name, self.default_popup_style)
         self.emit("theme_reloaded")
 
+    def __load_tar(self):
+        # The hash identifies the theme in the icon surface cache.
+        with open(self.theme_path, "rb") as f:
+            self.hash = hashlib.md5(f.read()).hexdigest()
+        tar = taropen(self.theme_path)
+        for member in tar.getmembers():
+            if member.name == "config":
+                config = tar.extractfile(member)
+                break
+
+        # Parse
+        parser = make_parser()
+        theme_handler = ThemeHandler()
+        parser.setContentHandler(theme_handler)
+        parser.parse(config)
+        self.theme = theme_handler.get_dict()
+
+        # Name
+        self.name = theme_handler.get_name()
+
+        self.types = theme_handler.get_types()
+
+        # Pixmaps
+        self.surfaces = {}
+        pixmaps = {}
+        if self.theme.has_key("pixmaps"):
+            pixmaps = self.theme["pixmaps"]["content"]
+        for (type_, d) in list(pixmaps.items()):
+            if type_ == "pixmap_from_file":
+                self.surfaces[d["name"]] = self.load_surface(tar, d["file"])
+        config.close()
+        tar.close()
+
     def check(self, path_to_tar):
         #TODO: Optimize this
         tar = taropen(path_to_tar)
@@ -454,6 +474,18 @@ class PopupStyle(GObject.GObject):
         self.settings = {"border_color2": "#000000",
                          "menu_item_lr_padding": 3}
         self.name = "DBX"
+        compiled = themecache.load(self.style_path, "popup_style")
+        if compiled is not None:
+            data, surfaces = compiled
+            self.name = data["name"]
+            self.settings = data["settings"]
+            self.bg = surfaces.get("background.png")
+            self.cb_normal_pic = surfaces.get("closebutton/normal.png")
+            self.cb_pressed_pic = surfaces.get("closebutton/pressed.png")
+            self.cb_hover_pic = surfaces.get("closebutton/hover.png")
+            self.globals.set_popup_style(self.style_path.rsplit("/", 1)[-1])
+            self.emit("popup-style-reloaded")
+            return
         try:
             tar = taropen(self.style_path)
         except:
@@ -526,6 +558,12 @@ class PopupStyle(GObject.GObject):
             self.cb_hover_pic = cairo.ImageSurface.create_from_png(cbf)
             cbf.close()
         tar.close()
+        themecache.save(self.style_path, "popup_style",
+                        {"name": self.name, "settings": self.settings},
+                        {"background.png": self.bg,
+                         "closebutton/normal.png": self.cb_normal_pic,
+                         "closebutton/pressed.png": self.cb_pressed_pic,
+                         "closebutton/hover.png": self.cb_hover_pic})
 
         # Inform rest of dockbar about the reload.
         self.globals.set_popup_style(self.style_path.rsplit("/", 1)[-1])
@@ -538,22 +576,28 @@ class PopupStyle(GObject.GObject):
         home_folder = os.path.expanduser("~")
         style_folder = home_folder + "/.dockbarx/themes/popup_styles"
         dirs = ["/usr/share/dockbarx/themes/popup_styles", style_folder]
+        style_paths = []
         for dir in dirs:
             if os.path.exists(dir) and os.path.isdir(dir):
                 for f in os.listdir(dir):
                     if f[-7:] == ".tar.gz":
-                        name, oft = self.check(dir+"/"+f)
-                        if oft:
-                            # The style is meant only for themes
-                            # mentioned in oft.
-                            if theme_name is None:
-                                continue
-                            oft = [t.strip().lstrip().lower() \
-                                   for t in oft.split(",")]
-                            if not theme_name.lower() in oft:
-                                continue
-                        if name:
-                            styles[name] = f
+                        style_paths.append(dir+"/"+f)
+        catalog = themecache.ThemeCatalog()
+        checked = catalog.check_files("popup_style", style_paths, self.check)
+        for path in style_paths:
+            f = path.rsplit("/", 1)[-1]
+            name, oft = checked.get(path) or (None, None)
+            if oft:
+                # The style is meant only for themes
+                # mentioned in oft.
+                if theme_name is None:
+                    continue
+                oft = [t.strip().lstrip().lower() \
+                       for t in oft.split(",")]
+                if not theme_name.lower() in oft:
+                    continue
+            if name:
+                styles[name] = f
         # The default style (if the theme doesn't set another one) is DBX,
         # wheter or not the file actually exists.
         if not "DBX" in styles:
@@ -621,7 +665,7 @@ class DockTheme(GObject.GObject):
         if size != self.bg_sizes[bar]:
             bg = self.bg[bar]
             w = bg.get_width()
-            self.resized_bg[bar] = self.__resize_surface(bg, w, size)
+            self.resized_bg[bar] = pixelops.resize_surface(bg, w, size)
             self.bg_sizes[bar] = size
         return self.resized_bg[bar]
 
@@ -654,6 +698,17 @@ class DockTheme(GObject.GObject):
             return
         self.default_colors = {"bg-color": "#111111", "bg-alpha": 127,
                                "bar2-bg-color":"#111111", "bar2-bg-alpha": 127}
+        compiled = themecache.load(self.theme_path, "dock_theme")
+        if compiled is not None:
+            data, surfaces = compiled
+            self.name = data["name"]
+            self.settings = data["settings"]
+            self.bg = {1: surfaces.get("background.png"),
+                       2: surfaces.get("bar2_background.png")}
+            self.bg_sizes = {1: -1, 2: -1}
+            self.resized_bg = {}
+            self.__set_default_colors()
+            return
         try:
             tar = taropen(self.theme_path)
         except:
@@ -730,7 +785,13 @@ class DockTheme(GObject.GObject):
             self.bg[2] = cairo.ImageSurface.create_from_png(bgf)
             bgf.close()
         tar.close()
+        themecache.save(self.theme_path, "dock_theme",
+                        {"name": self.name, "settings": self.settings},
+                        {"background.png": self.bg[1],
+                         "bar2_background.png": self.bg[2]})
+        self.__set_default_colors()
 
+    def __set_default_colors(self):
         for key in list(self.default_colors.keys()):
             if key in self.settings:
                 value = self.settings.pop(key)
@@ -752,13 +813,19 @@ class DockTheme(GObject.GObject):
         home_folder = os.path.expanduser("~")
         theme_folder = home_folder + "/.dockbarx/themes/dock"
         dirs = ["/usr/share/dockbarx/themes/dock", theme_folder]
+        theme_paths = []
         for dir in dirs:
             if os.path.exists(dir) and os.path.isdir(dir):
                 for f in os.listdir(dir):
                     if f[-7:] == ".tar.gz":
-                        name = self.check(dir+"/"+f)
-                        if name:
-                            themes[name] = f
+                        theme_paths.append(dir+"/"+f)
+        catalog = themecache.ThemeCatalog()
+        checked = catalog.check_files("dock_theme", theme_paths, self.check)
+        for path in theme_paths:
+            f = path.rsplit("/", 1)[-1]
+            name = checked.get(path)
+            if name:
+                themes[name] = f
         # The default theme (if the theme doesn't set another one) is DBX,
         # wheter or not the file actually exists.
         if not "DBX" in themes:
@@ -801,36 +868,3 @@ class DockTheme(GObject.GObject):
                 break
         tar.close()
         return name
-
-    def __surface2pil(self, surface):
-        w = surface.get_width()
-        h = surface.get_height()
-        return Image.frombuffer("RGBA", (w, h), surface.get_data().tobytes(),
-                                "raw", "RGBA", 0,1)
-
-
-    def __pil2surface(self, im):
-        """Transform a PIL Image into a Cairo ImageSurface."""
-
-        # This function is only supposed to work with little endinan
-        # systems. Could that be a problem ever?
-        if im.mode != 'RGBA':
-            im = im.convert('RGBA')
-
-        s = im.tobytes('raw', 'BGRA')
-        a = array.array('B', s)
-        dest = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                  im.size[0], im.size[1])
-        ctx = cairo.Context(dest)
-        non_premult_src_wo_alpha = cairo.ImageSurface.create_for_data(
-            a, cairo.FORMAT_RGB24, im.size[0], im.size[1])
-        non_premult_src_alpha = cairo.ImageSurface.create_for_data(
-            a, cairo.FORMAT_ARGB32, im.size[0], im.size[1])
-        ctx.set_source_surface(non_premult_src_wo_alpha)
-        ctx.mask_surface(non_premult_src_alpha)
-        return dest
-
-    def __resize_surface(self, surface, w, h):
-        im = self.__surface2pil(surface)
-        im = im.resize((w, h), Image.ANTIALIAS)
-        return self.__pil2surface(im)
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+#   themecache.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compiled themes.
+#
+# Loading a theme, popup style or dock theme from its .tar.gz means
+# decompressing the tar, parsing the configuration and decoding PNGs.
+# The first time a theme file is loaded the result is saved in a compiled
+# file under the user cache directory. Later loads just memory map that
+# file. The .tar.gz stays the source of truth: the compiled file is only
+# used if the path, modification time and size of the tar still match.
+#
+# ThemeCatalog keeps the names of all theme files, so that they
+# don't need to be opened every time the themes are listed.
+#
+# Compiled file layout:
+#   header   - magic, version, metadata length, pixel data offset (32 bytes)
+#   metadata - json: the source file, the parsed data and the surfaces
+#   pixels   - the raw cairo data of every surface, 16 byte aligned
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+import cairo
+from gi.repository import GLib
+
+from .common import ODict
+from .log import logger
+
+HEADER = struct.Struct("=4sIQQ8x")
+MAGIC = b"DBXC"
+VERSION = 1
+ALIGN = 16
+
+
+def get_cache_path(path, kind):
+    folder = os.path.join(GLib.get_user_cache_dir(), "dockbarx", "themes")
+    name = hashlib.sha1(("%s:%s" % (kind, path)).encode()).hexdigest()
+    return os.path.join(folder, name)
+
+def get_source_id(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_mtime, st.st_size]
+
+def load(path, kind):
+    """Returns (data, surfaces) for the compiled theme file
+    or None if there is no valid compiled file."""
+    try:
+        source = get_source_id(path)
+        with open(get_cache_path(path, kind), "rb") as f:
+            # ACCESS_COPY gives a private writable mapping
+            # that cairo can use as pixel buffers.
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, length, start = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            return None
+        meta = json.loads(mm[HEADER.size:HEADER.size + length].decode())
+        if meta["source"] != source or meta["kind"] != kind:
+            return None
+        buf = memoryview(mm)
+        surfaces = {}
+        for name, (offset, format, w, h, stride) in \
+            list(meta["surfaces"].items()):
+            offset += start
+            if offset + stride * h > len(mm):
+                return None
+            surfaces[name] = cairo.ImageSurface.create_for_data(
+                                            buf[offset:offset + stride * h],
+                                            format, w, h, stride)
+    except (struct.error, ValueError, KeyError, TypeError, cairo.Error):
+        logger.exception("Couldn't read the compiled %s %s" % (kind, path))
+        return None
+    return meta["data"], surfaces
+
+def save(path, kind, data, surfaces):
+    """Saves a compiled theme file. data has to be json serializable."""
+    cache_path = get_cache_path(path, kind)
+    meta = {"source": get_source_id(path),
+            "kind": kind,
+            "data": data,
+            "surfaces": {}}
+    # The offsets are relative to the start of the pixel data.
+    blobs = []
+    offset = 0
+    for name, surface in list(surfaces.items()):
+        if surface is None:
+            continue
+        surface.flush()
+        stride = surface.get_stride()
+        h = surface.get_height()
+        meta["surfaces"][name] = [offset, int(surface.get_format()),
+                                  surface.get_width(), h, stride]
+        blobs.append(surface.get_data())
+        offset += stride * h
+        offset += -offset % ALIGN
+    meta_bytes = json.dumps(meta).encode()
+    start = HEADER.size + len(meta_bytes)
+    start += -start % ALIGN
+    tmp = "%s.%s.tmp" % (cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(meta_bytes), start))
+            f.write(meta_bytes)
+            f.write(b"\0" * (start - HEADER.size - len(meta_bytes)))
+            for blob in blobs:
+                f.write(blob)
+                f.write(b"\0" * (-len(blob) % ALIGN))
+        os.replace(tmp, cache_path)
+    except OSError:
+        logger.warning("Couldn't save the compiled %s %s" % (kind, path))
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def odict_to_list(odict):
+    # Makes a json serializable version of the ODict tree from ThemeHandler.
+    l = []
+    for key, d in list(odict.items()):
+        d = dict(d)
+        if "content" in d:
+            d["content"] = odict_to_list(d["content"])
+        l.append([key, d])
+    return l
+
+def list_to_odict(l):
+    odict = ODict()
+    for key, d in l:
+        if "content" in d:
+            d["content"] = list_to_odict(d["content"])
+        odict[key] = d
+    return odict
+
+
+class ThemeCatalog():
+    """An index of the theme files and what their check gave.
+
+    The index is saved in the user cache directory. A theme
+    file is only checked again if its mtime or size has changed."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "entries" in self.__dict__:
+            return
+        self.path = os.path.join(GLib.get_user_cache_dir(),
+                                 "dockbarx", "theme-catalog.json")
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                catalog = json.load(f)
+            if catalog.get("version") == VERSION:
+                self.entries = catalog["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def check_files(self, kind, paths, check):
+        """Returns a dict of path: check(path) for the paths.
+
+        kind is the kind of theme (theme, popup_style or dock_theme).
+        The result is None for files where check raised an exception."""
+        old = self.entries.get(kind, {})
+        new = {}
+        results = {}
+        changed = set(old.keys()) != set(paths)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = old.get(path)
+            if entry is None or entry[0] != st.st_mtime or \
+               entry[1] != st.st_size:
+                try:
+                    result = check(path)
+                except Exception:
+                    logger.exception("Error loading theme from %s" % path)
+                    result = None
+                entry = [st.st_mtime, st.st_size, result]
+                changed = True
+            new[path] = entry
+            results[path] = entry[2]
+        if changed:
+            self.entries[kind] = new
+            self.__save()
+        return results
+
+    def __save(self):
+        tmp = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"version": VERSION, "entries": self.entries}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            logger.warning("Couldn't save the theme catalog %s" % self.path)
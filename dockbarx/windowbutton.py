@@ -21,6 +21,7 @@
 
 import gi
 from gi.repository import Gtk
+from gi.repository import Gdk
 from gi.repository import GObject
 from gi.repository import GdkPixbuf
 from gi.repository import Pango
@@ -31,15 +32,11 @@ import weakref
 import gc
 gc.enable()
 
-### use set_preview
-from Xlib import X
-from Xlib.display import Display
-from PIL import Image
-
 from .common import ODict, Globals, Opacify
 from .common import connect, disconnect, opacify, deopacify
 from .cairowidgets import *
 from .log import logger
+from .previews import PreviewCache
 
 from . import i18n
 _ = i18n.language.gettext
@@ -80,13 +77,15 @@ class Window():
                                                 self.__on_window_name_changed)
         self.geometry_changed_event = self.wnck.connect("geometry-changed",
                                                 self.__on_geometry_changed)
+        self.workspace_changed_event = self.wnck.connect("workspace-changed",
+                                                self.__on_workspace_changed)
         self.item = WindowItem(self, group)
         self.needs_attention = self.wnck.needs_attention()
         self.item.show()
         self.__on_show_only_current_monitor_changed()
 
     def __ne__(self, window):
-        if isinstance(window, wnck.Window):
+        if isinstance(window, Wnck.Window):
             return self.wnck != window
         else:
             return window is not self
@@ -114,9 +113,9 @@ class Window():
     def get_monitor(self):
         if not self.globals.settings["show_only_current_monitor"]:
             return 0
-        gdk_screen = gtk.gdk.screen_get_default()
+        gdk_screen = Gdk.Screen.get_default()
         x, y, w, h = self.wnck.get_geometry()
-        return gdk_screen.get_monitor_at_point(x + (w / 2), y  + (h / 2))
+        return gdk_screen.get_monitor_at_point(x + w // 2, y + h // 2)
 
     def destroy(self):
         if self.deopacify_sid:
@@ -129,6 +128,7 @@ class Window():
         self.wnck.disconnect(self.state_changed_event)
         self.wnck.disconnect(self.icon_changed_event)
         self.wnck.disconnect(self.name_changed_event)
+        self.wnck.disconnect(self.workspace_changed_event)
         if self.geometry_changed_event is not None:
             self.wnck.disconnect(self.geometry_changed_event)
         del self.screen
@@ -137,6 +137,7 @@ class Window():
 
     def __on_show_only_current_monitor_changed(self, arg=None):
         self.monitor = self.get_monitor()
+        self.group_r().update_window(self)
 
     def select_after_delay(self, delay):
         if self.select_sid:
@@ -150,15 +151,20 @@ class Window():
 
     #### Windows's Events
     def __on_window_state_changed(self, wnck_window,changed_mask, new_state):
+        group = self.group_r()
+        needs_attention = self.wnck.needs_attention()
+        attention_changed = needs_attention != self.needs_attention
+        self.needs_attention = needs_attention
+        # The counts must be right before the group button is updated.
+        group.update_window(self)
         if WNCK_WINDOW_STATE_MINIMIZED & changed_mask:
             self.item.minimized_changed()
-            self.group_r().button.update_state_if_shown()
+            group.button.update_state_if_shown()
 
         # Check if the window needs attention
-        if self.wnck.needs_attention() != self.needs_attention:
-            self.needs_attention = self.wnck.needs_attention()
+        if attention_changed:
             self.item.needs_attention_changed()
-            self.group_r().needs_attention_changed()
+            group.needs_attention_changed()
 
     def __on_window_icon_changed(self, window):
         self.item.icon_changed()
@@ -168,21 +174,42 @@ class Window():
 
     def __on_geometry_changed(self, *args):
         group = self.group_r()
+        monitor_changed = False
         if self.globals.settings["show_only_current_monitor"]:
             monitor = self.get_monitor()
             if monitor != self.monitor:
                 self.monitor = monitor
-                self.item.update_show_state()
-                group.window_monitor_changed()
-        if self.globals.settings["show_only_current_desktop"]:
-            onc = self.is_on_current_desktop()
-            if self.on_current_desktop != onc:
-                self.on_current_desktop = onc
-                self.item.update_show_state()
-                group.window_desktop_changed()
+                monitor_changed = True
+        desktop_changed = self.__update_on_current_desktop()
+        group.update_window(self)
+        if monitor_changed:
+            self.item.update_show_state()
+            group.window_monitor_changed()
+        if desktop_changed:
+            self.item.update_show_state()
+            group.window_desktop_changed()
         if self.globals.settings["preview"]:
             self.item.update_preview()
 
+    def __on_workspace_changed(self, *args):
+        group = self.group_r()
+        desktop_changed = self.__update_on_current_desktop()
+        group.update_window(self)
+        if desktop_changed:
+            self.item.update_show_state()
+            group.window_desktop_changed()
+
+    def __update_on_current_desktop(self):
+        # Returns True if the window has been moved to or from
+        # the current desktop and that matters.
+        if not self.globals.settings["show_only_current_desktop"]:
+            return False
+        onc = self.is_on_current_desktop()
+        if self.on_current_desktop == onc:
+            return False
+        self.on_current_desktop = onc
+        return True
+
     def desktop_changed(self):
         self.on_current_desktop = self.is_on_current_desktop()
         if self.on_current_desktop:
@@ -379,6 +406,7 @@ class WindowItem(CairoButton):
             GLib.source_remove(self.opacify_sid)
         if self.press_sid:
             GLib.source_remove(self.press_sid)
+        PreviewCache().forget(window.xid)
         self.close_button.destroy()
 
     def show(self):
@@ -418,34 +446,35 @@ class WindowItem(CairoButton):
         self.label.set_size_request(size, -1)
         #self.size_request()
 
-    def __make_minimized_icon(self, icon):
-        pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True,
-                                          8, icon.get_width(),
-                                          icon.get_height())
-        pixbuf.fill(0x00000000)
-        minimized_icon = pixbuf.copy()
-        icon.composite(pixbuf, 0, 0, pixbuf.get_width(),
-                         pixbuf.get_height(), 0, 0, 1, 1,
-                         GdkPixbuf.InterpType.BILINEAR, 190)
-        pixbuf.saturate_and_pixelate(minimized_icon, 0.12, False)
-        return minimized_icon
-
     def __update_icon(self):
         window = self.window_r()
         icon = window.wnck.get_mini_icon()
         if window.wnck.is_minimized():
-            pixbuf = self.__make_minimized_icon(icon)
+            previews = PreviewCache()
+            pixbuf = previews.get_minimized_icon(self.__get_app(), icon)
             self.icon_image.set_from_pixbuf(pixbuf)
             if self.globals.settings["preview"] and \
                (self.globals.get_compiz_version() < "0.9" or \
                not self.globals.settings["preview_minimized"]):
-                   self.preview.set_from_pixbuf(window.wnck.get_icon())
+                preview = previews.get_snapshot(window.xid, self.preview_w,
+                                                self.preview_h)
+                if preview is None:
+                    preview = window.wnck.get_icon()
+                self.preview.set_from_pixbuf(preview)
         else:
             self.icon_image.set_from_pixbuf(icon)
             self.preview.clear()
 
     def minimized_changed(self):
         window = self.window_r()
+        previews = PreviewCache()
+        if window.wnck.is_minimized():
+            # The pixmap of the window is usually gone now,
+            # show the last capture instead.
+            previews.cancel(window.xid)
+            previews.keep_snapshot(window.xid)
+        else:
+            previews.drop_snapshot(window.xid)
         self.__update_label()
         self.__update_icon()
         self.area.set_minimized(window.wnck.is_minimized())
@@ -456,8 +485,16 @@ class WindowItem(CairoButton):
         self.__update_label()
 
     def icon_changed(self):
+        PreviewCache().drop_minimized_icons(self.__get_app())
         self.__update_icon()
 
+    def __get_app(self):
+        # The windows of a group share their faded icon.
+        group = self.group_r()
+        if group is not None and group.identifier:
+            return group.identifier
+        return self.window_r().wnck.get_class_group().get_res_class()
+
     def needs_attention_changed(self):
         window = self.window_r()
         self.area.set_needs_attention(window.wnck.needs_attention())
@@ -479,48 +516,35 @@ class WindowItem(CairoButton):
         else:
             self.show()
 
-    def __get_window_pixbuf(self, pixmap, to_w, to_h):
-        geo = pixmap.get_geometry()
-        di = pixmap.get_image(0, 0, geo.width, geo.height, X.ZPixmap, 0xffffffff)
-
-        img = Image.frombytes('RGBA', (geo.width, geo.height), di.data, 'raw', 'BGRA')
-        img_pixbuf = GdkPixbuf.Pixbuf.new_from_data(img.tobytes(), GdkPixbuf.Colorspace.RGB, True, 8, \
-                                                    geo.width, geo.height,\
-                                                    len(img.getbands()) * geo.width,\
-                                                    None, None)
-
-        pixbuf = img_pixbuf.scale_simple(to_w, to_h, GdkPixbuf.InterpType.BILINEAR)
-
-        del di
-        del img
-        del img_pixbuf
-        return pixbuf
-
     ####Preview
     def set_preview(self, is_visible):
-        #from Xlib.display import Display
         window = self.window_r()
         if self.globals.settings["preview"] is False or \
            window.wnck.is_minimized():
             return
 
+        previews = PreviewCache()
         if is_visible is False:
+            previews.cancel(window.xid)
             #self.preview.set_from_pixbuf(None)
             self.preview.clear()
             return
 
-        d = Display()
-        pixmap = d.create_resource_object('pixmap', window.xid)
-
-        pixbuf = self.__get_window_pixbuf(pixmap, self.preview_w, self.preview_h)
-        if pixbuf is not None:
-            self.preview.set_from_pixbuf(pixbuf)
-
-        del pixbuf
-        pixmap.free()
-        del pixmap
-        d.close()
-        del d
+        # Show what there is right away, the capture
+        # replaces it when it's ready.
+        pixbuf = previews.get_any(window.xid,
+                                  self.preview_w, self.preview_h)
+        if pixbuf is None:
+            pixbuf = window.wnck.get_icon()
+        self.preview.set_from_pixbuf(pixbuf)
+        previews.request(window.xid, self.preview_w, self.preview_h,
+                         self.__on_preview_captured)
+
+    def __on_preview_captured(self, pixbuf):
+        window = self.window_r()
+        if window is None or window.wnck.is_minimized():
+            return
+        self.preview.set_from_pixbuf(pixbuf)
 
     def update_preview(self, *args):
         window = self.window_r()
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+#   xconnection.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+from gi.repository import GLib
+from Xlib import display
+from Xlib import error
+
+from .log import logger
+
+
+class XConnection():
+    """The python-xlib connection to the X server that dockbarx uses.
+
+    Opening a display means a new socket, a handshake with the server
+    and extension queries, so only one connection is opened, the first
+    time it's needed, and it's kept open. Interned atoms are cached.
+    The file descriptor of the connection is watched from the GLib main
+    loop so that events and errors from the server are read when they
+    arrive instead of piling up in the socket. Events are passed on to
+    the handlers added for their type.
+
+    Requests that wait for a reply can read events into python-xlib's
+    queue without waking the watch, so events are also dispatched when
+    the main loop is idle after the display has been used."""
+
+    def __new__(cls, *p, **k):
+        if not "_the_instance" in cls.__dict__:
+            cls._the_instance = object.__new__(cls)
+        return cls._the_instance
+
+    def __init__(self):
+        if "atoms" in self.__dict__:
+            return
+        self.display = None
+        self.atoms = {}
+        self.watch_sid = None
+        self.drain_sid = None
+        # event type: [handler, ...]
+        self.event_handlers = {}
+
+    def get_display(self):
+        if self.display is None:
+            self.__open()
+        if self.drain_sid is None:
+            self.drain_sid = GLib.idle_add(self.__drain)
+        return self.display
+
+    def get_root(self):
+        return self.get_display().screen().root
+
+    def get_window(self, xid):
+        return self.get_display().create_resource_object("window", xid)
+
+    def get_atom(self, name, only_if_exists=False):
+        """Returns the atom for name, interning it only the first time.
+
+        If only_if_exists is True and there is no such atom X.NONE (0)
+        is returned. That isn't cached since the atom could be created
+        later."""
+        atom = self.atoms.get(name)
+        if atom is None:
+            atom = self.get_display().intern_atom(name, only_if_exists)
+            if atom:
+                self.atoms[name] = atom
+        return atom
+
+    def has_extension(self, name):
+        return self.get_display().has_extension(name)
+
+    def add_event_handler(self, event_type, handler):
+        """Calls handler(event) for every event of event_type."""
+        self.event_handlers.setdefault(event_type, []).append(handler)
+
+    def remove_event_handler(self, event_type, handler):
+        handlers = self.event_handlers.get(event_type, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self.event_handlers.pop(event_type, None)
+
+    def flush(self):
+        """Sends the requests that are still in the output buffer."""
+        if self.display is not None:
+            self.display.flush()
+
+    def close(self):
+        if self.watch_sid is not None:
+            GLib.source_remove(self.watch_sid)
+            self.watch_sid = None
+        if self.drain_sid is not None:
+            GLib.source_remove(self.drain_sid)
+            self.drain_sid = None
+        if self.display is not None:
+            try:
+                self.display.close()
+            except error.ConnectionClosedError:
+                pass
+            self.display = None
+        self.atoms = {}
+
+    def __open(self):
+        self.display = display.Display()
+        self.display.set_error_handler(self.__on_error)
+        self.atoms = {}
+        self.watch_sid = GLib.io_add_watch(self.display.fileno(),
+                                           GLib.PRIORITY_DEFAULT,
+                                           GLib.IOCondition.IN | \
+                                           GLib.IOCondition.ERR | \
+                                           GLib.IOCondition.HUP,
+                                           self.__on_readable)
+
+    def __on_readable(self, fd, condition):
+        if condition & (GLib.IOCondition.ERR | GLib.IOCondition.HUP):
+            logger.warning("The connection to the X server was closed.")
+            self.watch_sid = None
+            self.close()
+            return False
+        if not self.__dispatch_events():
+            self.watch_sid = None
+            self.close()
+            return False
+        return True
+
+    def __drain(self):
+        self.drain_sid = None
+        if self.display is not None and not self.__dispatch_events():
+            self.close()
+        return False
+
+    def __dispatch_events(self):
+        # Returns False if the connection has been closed.
+        try:
+            # pending_events() reads what has arrived without blocking.
+            while self.display.pending_events():
+                event = self.display.next_event()
+                for handler in self.event_handlers.get(event.type, [])[:]:
+                    try:
+                        handler(event)
+                    except Exception:
+                        logger.exception("Error in X event handler:")
+        except error.ConnectionClosedError:
+            logger.warning("The connection to the X server was closed.")
+            return False
+        return True
+
+    def __on_error(self, err, request):
+        # Windows can be gone by the time a request about them arrives.
+        logger.debug("X error: %s" % err)
@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+#   xshm.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading window pixels through a MIT-SHM shared memory segment.
+# python-xlib doesn't have the MIT-SHM extension, so libxcb and
+# libxcb-shm are used with ctypes. Xcb reports errors with the replies
+# instead of through a process wide error handler, which makes it safe
+# to use next to Gtk and from another thread.
+
+import ctypes
+import ctypes.util
+
+from .log import logger
+
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+XCB_IMAGE_FORMAT_Z_PIXMAP = 2
+
+
+class Cookie(ctypes.Structure):
+    _fields_ = [("sequence", ctypes.c_uint)]
+
+class GeometryReply(ctypes.Structure):
+    _fields_ = [("response_type", ctypes.c_uint8),
+                ("depth", ctypes.c_uint8),
+                ("sequence", ctypes.c_uint16),
+                ("length", ctypes.c_uint32),
+                ("root", ctypes.c_uint32),
+                ("x", ctypes.c_int16),
+                ("y", ctypes.c_int16),
+                ("width", ctypes.c_uint16),
+                ("height", ctypes.c_uint16),
+                ("border_width", ctypes.c_uint16),
+                ("pad0", ctypes.c_uint8 * 2)]
+
+class ShmGetImageReply(ctypes.Structure):
+    _fields_ = [("response_type", ctypes.c_uint8),
+                ("depth", ctypes.c_uint8),
+                ("sequence", ctypes.c_uint16),
+                ("length", ctypes.c_uint32),
+                ("visual", ctypes.c_uint32),
+                ("size", ctypes.c_uint32)]
+
+
+def load_libraries():
+    # Returns (xcb, xcb_shm, libc) or None.
+    names = (ctypes.util.find_library("xcb"),
+             ctypes.util.find_library("xcb-shm"),
+             ctypes.util.find_library("c"))
+    if None in names:
+        return None
+    try:
+        xcb, shm, libc = [ctypes.CDLL(name) for name in names]
+    except OSError:
+        return None
+    c = ctypes.c_void_p
+    error_p = ctypes.POINTER(ctypes.c_void_p)
+    xcb.xcb_connect.restype = c
+    xcb.xcb_connect.argtypes = [ctypes.c_char_p,
+                                ctypes.POINTER(ctypes.c_int)]
+    xcb.xcb_connection_has_error.argtypes = [c]
+    xcb.xcb_disconnect.restype = None
+    xcb.xcb_disconnect.argtypes = [c]
+    xcb.xcb_generate_id.restype = ctypes.c_uint32
+    xcb.xcb_generate_id.argtypes = [c]
+    xcb.xcb_request_check.restype = c
+    xcb.xcb_request_check.argtypes = [c, Cookie]
+    xcb.xcb_get_geometry.restype = Cookie
+    xcb.xcb_get_geometry.argtypes = [c, ctypes.c_uint32]
+    xcb.xcb_get_geometry_reply.restype = ctypes.POINTER(GeometryReply)
+    xcb.xcb_get_geometry_reply.argtypes = [c, Cookie, error_p]
+    shm.xcb_shm_query_version.restype = Cookie
+    shm.xcb_shm_query_version.argtypes = [c]
+    shm.xcb_shm_query_version_reply.restype = c
+    shm.xcb_shm_query_version_reply.argtypes = [c, Cookie, error_p]
+    shm.xcb_shm_attach_checked.restype = Cookie
+    shm.xcb_shm_attach_checked.argtypes = [c, ctypes.c_uint32,
+                                           ctypes.c_uint32, ctypes.c_uint8]
+    shm.xcb_shm_detach.restype = Cookie
+    shm.xcb_shm_detach.argtypes = [c, ctypes.c_uint32]
+    shm.xcb_shm_get_image.restype = Cookie
+    shm.xcb_shm_get_image.argtypes = [c, ctypes.c_uint32,
+                                      ctypes.c_int16, ctypes.c_int16,
+                                      ctypes.c_uint16, ctypes.c_uint16,
+                                      ctypes.c_uint32, ctypes.c_uint8,
+                                      ctypes.c_uint32, ctypes.c_uint32]
+    shm.xcb_shm_get_image_reply.restype = ctypes.POINTER(ShmGetImageReply)
+    shm.xcb_shm_get_image_reply.argtypes = [c, Cookie, error_p]
+    libc.shmget.restype = ctypes.c_int
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmat.restype = c
+    libc.shmat.argtypes = [ctypes.c_int, c, ctypes.c_int]
+    libc.shmdt.argtypes = [c]
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, c]
+    libc.free.restype = None
+    libc.free.argtypes = [c]
+    return xcb, shm, libc
+
+
+class ShmImageReader():
+    """Reads the pixels of windows and pixmaps through MIT-SHM.
+
+    The reader has its own connection to the X server and should be
+    used from one thread only. available is False if the libraries or
+    the extension are missing or if the X server can't attach the
+    segment (it's on another machine), then get_image() isn't used."""
+
+    def __init__(self):
+        self.available = False
+        self.conn = None
+        self.shmid = -1
+        self.addr = None
+        self.seg = None
+        self.seg_size = 0
+        libraries = load_libraries()
+        if libraries is None:
+            logger.debug("MIT-SHM capture: libxcb-shm is not available.")
+            return
+        self.xcb, self.shm, self.libc = libraries
+        self.conn = self.xcb.xcb_connect(None, None)
+        if not self.conn or self.xcb.xcb_connection_has_error(self.conn):
+            logger.debug("MIT-SHM capture: couldn't connect to X.")
+            self.close()
+            return
+        cookie = self.shm.xcb_shm_query_version(self.conn)
+        reply = self.shm.xcb_shm_query_version_reply(self.conn, cookie, None)
+        if not reply:
+            logger.debug("MIT-SHM capture: the X server has no MIT-SHM.")
+            self.close()
+            return
+        self.libc.free(reply)
+        self.available = True
+
+    def get_image(self, drawable):
+        """Returns (pixels, width, height) or None.
+
+        The pixels are BGRA (ZPixmap, 32 bits per pixel) in the shared
+        segment and are only valid until the next call."""
+        if not self.available:
+            return None
+        error = ctypes.c_void_p()
+        cookie = self.xcb.xcb_get_geometry(self.conn, drawable)
+        reply = self.xcb.xcb_get_geometry_reply(self.conn, cookie,
+                                                ctypes.byref(error))
+        if not reply:
+            self.libc.free(error)
+            return None
+        width = reply.contents.width
+        height = reply.contents.height
+        self.libc.free(reply)
+        size = width * height * 4
+        if not size or not self.__reserve(size):
+            return None
+        cookie = self.shm.xcb_shm_get_image(self.conn, drawable, 0, 0,
+                                            width, height, 0xffffffff,
+                                            XCB_IMAGE_FORMAT_Z_PIXMAP,
+                                            self.seg, 0)
+        reply = self.shm.xcb_shm_get_image_reply(self.conn, cookie,
+                                                 ctypes.byref(error))
+        if not reply:
+            # The window is gone or not viewable.
+            self.libc.free(error)
+            return None
+        written = reply.contents.size
+        self.libc.free(reply)
+        if written != size:
+            # Not 32 bits per pixel.
+            return None
+        return (ctypes.c_char * size).from_address(self.addr), width, height
+
+    def __reserve(self, size):
+        # Makes sure the segment has room for size bytes.
+        if size <= self.seg_size:
+            return True
+        self.__free_segment()
+        # Grow in steps so that slightly bigger windows
+        # don't need a new segment every time.
+        size = (size + 0xfffff) & ~0xfffff
+        shmid = self.libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if shmid < 0:
+            logger.debug("MIT-SHM capture: shmget failed.")
+            self.available = False
+            return False
+        addr = self.libc.shmat(shmid, None, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            self.libc.shmctl(shmid, IPC_RMID, None)
+            logger.debug("MIT-SHM capture: shmat failed.")
+            self.available = False
+            return False
+        seg = self.xcb.xcb_generate_id(self.conn)
+        cookie = self.shm.xcb_shm_attach_checked(self.conn, seg, shmid, 0)
+        error = self.xcb.xcb_request_check(self.conn, cookie)
+        # The segment is removed when both sides have detached.
+        self.libc.shmctl(shmid, IPC_RMID, None)
+        if error:
+            self.libc.free(error)
+            self.libc.shmdt(addr)
+            logger.debug("MIT-SHM capture: the X server couldn't " + \
+                         "attach the segment.")
+            self.available = False
+            return False
+        self.shmid = shmid
+        self.addr = addr
+        self.seg = seg
+        self.seg_size = size
+        return True
+
+    def __free_segment(self):
+        if self.seg is not None:
+            self.shm.xcb_shm_detach(self.conn, self.seg)
+            self.seg = None
+        if self.addr is not None:
+            self.libc.shmdt(self.addr)
+            self.addr = None
+        self.shmid = -1
+        self.seg_size = 0
+
+    def close(self):
+        if self.conn:
+            self.__free_segment()
+            self.xcb.xcb_disconnect(self.conn)
+        self.conn = None
+        self.available = False
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+#   test_monitor_recount.py
+#
+#   Copyright (C) 2019 Gooroom <gooroom@gooroom.kr>
+#
+#   DockbarX is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   DockbarX is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dockbar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checks that the shown window counts of the groups are recounted when
+# the dock moves to another monitor or the monitors change. Real Group
+# objects are used without __init__, with fake windows and buttons, and
+# the monitor of the dock is set by the test.
+#
+# Needs the same python modules as dockbarx, but no X display.
+#
+# Usage: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dockbarx.dockbar import DockBar
+from dockbarx.groupbutton import Group, ListOfWindows
+
+
+class FakeGlobals():
+    def __init__(self):
+        self.settings = {"show_only_current_desktop": False,
+                         "show_only_current_monitor": True}
+
+class FakeWnck():
+    def __init__(self, minimized=False):
+        self.minimized = minimized
+
+    def is_minimized(self):
+        return self.minimized
+
+class FakeItem():
+    def __init__(self):
+        self.updates = 0
+
+    def update_show_state(self):
+        self.updates += 1
+
+class FakeWindow():
+    def __init__(self, xid, monitor, minimized=False):
+        self.xid = xid
+        self.wnck = FakeWnck(minimized)
+        self.needs_attention = False
+        self.item = FakeItem()
+        self.monitor = monitor
+        self.current_monitor = monitor
+
+    def get_monitor(self):
+        return self.current_monitor
+
+class FakeButton():
+    def __init__(self):
+        self.updates = 0
+        self.moves = 0
+
+    def update_state(self, *args, **kwargs):
+        self.updates += 1
+
+    def dockbar_moved(self):
+        self.moves += 1
+
+
+class MonitorRecountTest(unittest.TestCase):
+    def setUp(self):
+        self.dock_monitor = 0
+        self.dockbar = DockBar.__new__(DockBar)
+        self.dockbar.groups = [self.make_group([(1, 0), (2, 1, True)]),
+                               self.make_group([(3, 1), (4, 1)])]
+
+    def make_group(self, windows):
+        # A Group without __init__, with just what the recount uses.
+        group = Group.__new__(Group)
+        ListOfWindows.__init__(group)
+        group.globals = FakeGlobals()
+        group.button = FakeButton()
+        group.nextlist = None
+        group.get_monitor = lambda: self.dock_monitor
+        group.update_monitor = lambda: setattr(group, "monitor",
+                                               self.dock_monitor)
+        group.update_monitor()
+        group.extend([FakeWindow(*window) for window in windows])
+        return group
+
+    def get_counts(self):
+        return [(group.get_count(), group.get_minimized_count())
+                for group in self.dockbar.groups]
+
+    def test_dockbar_moved(self):
+        self.assertEqual(self.get_counts(), [(1, 0), (0, 0)])
+        self.dock_monitor = 1
+        self.dockbar.dockbar_moved()
+        self.assertEqual(self.get_counts(), [(1, 1), (2, 0)])
+        for group in self.dockbar.groups:
+            self.assertEqual(group.monitor, 1)
+            self.assertEqual(group.button.updates, 1)
+            self.assertEqual(group.button.moves, 1)
+            for window in group:
+                self.assertEqual(window.item.updates, 1)
+
+    def test_monitors_changed(self):
+        # The windows of the second monitor end up on the first one.
+        for group in self.dockbar.groups:
+            for window in group:
+                window.current_monitor = 0
+        self.dockbar._DockBar__on_monitors_changed(None)
+        self.assertEqual(self.get_counts(), [(2, 1), (2, 0)])
+        self.assertEqual(len(self.dockbar.groups[1].get_windows()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()